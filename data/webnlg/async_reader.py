@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+sys.path.append(os.path.abspath('.'))
+from utils import DataSetType, NLP, Cleaner, load_json
+from reader import RDFFileReader, WebNLGDataReader
+from raw_index import RawIndex
+
+_worker_nlp = None
+
+
+def plan_file(file_name, raw_index: RawIndex, chunk_size):
+    '''
+    Cleans the file and splits its entries into chunks of `chunk_size` eids,
+    or [None] (the whole file) when its entries cannot be indexed.
+    '''
+    Cleaner().clean(file_name)
+    try:
+        eids = list(raw_index.entries(file_name))
+    except ValueError:  # an <entry> is cut off, reported by the reader
+        eids = []
+    return [eids[i:i + chunk_size]
+            for i in range(0, len(eids), chunk_size)] or [None]
+
+
+def convert_file(file_name, xml_backend=None, eids=None, raw_index=None):
+    # runs in the executor; each worker thread/process loads spaCy once
+    global _worker_nlp
+    if _worker_nlp is None:
+        _worker_nlp = NLP()
+    return RDFFileReader(file_name, nlp=_worker_nlp,
+                         eids=set(eids) if eids is not None else None,
+                         raw_index=raw_index, xml_backend=xml_backend).data
+
+
+async def aiter_records(set: DataSetType, data_dir=None, executor=None,
+                        max_queued=1000, xml_backend=None, chunk_size=50):
+    '''
+    Converts a split's raw files in `executor` (by default one background
+    thread), `chunk_size` entries at a time, and yields the records of each
+    chunk as soon as it is converted, without blocking the event loop. At most
+    `max_queued` records wait in the queue: no further chunk is converted
+    while the consumer lags behind. Leaving the `async for` early, or
+    cancelling the consuming task, stops the conversion after the chunk in
+    progress.
+    '''
+    loop = asyncio.get_running_loop()
+    data_dir = data_dir or path.dirname(path.realpath(__file__))
+    files = WebNLGDataReader.recurse_files(path.join(data_dir, 'raw', set.value))
+    raw_index = RawIndex(path.join(data_dir, 'raw'))
+    queue = asyncio.Queue(maxsize=max_queued)
+    done = object()
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    async def produce():
+        for file_name in files:
+            chunks = await loop.run_in_executor(executor, plan_file, file_name,
+                                                raw_index, chunk_size)
+            for eids in chunks:
+                records = await loop.run_in_executor(
+                    executor, convert_file, file_name, xml_backend, eids,
+                    raw_index)
+                for record in records:
+                    await queue.put(record)
+        # saved once, so that the next run does not hash the files again
+        if raw_index.changed:
+            await loop.run_in_executor(executor, raw_index.save)
+        await queue.put(done)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait([getter, producer],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                # the producer failed before queueing anything else
+                getter.cancel()
+                producer.result()
+            record = getter.result()
+            if record is done: break
+            yield record
+    finally:
+        producer.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def aload_records(file_name, chunk_size=1000):
+    '''
+    Loads a saved split (e.g. train.json.gz) in a thread, then yields its
+    records, giving control back to the event loop every `chunk_size` records.
+    '''
+    data = await asyncio.get_running_loop().run_in_executor(None, load_json,
+                                                            file_name)
+    for record_ix, record in enumerate(data):
+        if record_ix % chunk_size == 0:
+            await asyncio.sleep(0)
+        yield record
+
+
+async def benchmark_latency(set: DataSetType, data_dir=None, interval=0.01):
+    '''
+    Converts a split through `aiter_records` while a ticker measures how late
+    the event loop wakes it up.
+    '''
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start - interval)
+
+    tick = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    num_records = 0
+    async for _ in aiter_records(set, data_dir=data_dir):
+        num_records += 1
+    seconds = time.perf_counter() - start
+    stop.set()
+    await tick
+
+    lags.sort()
+    result = {'split': set.value, 'records': num_records,
+              'seconds': round(seconds, 2),
+              'lag_ms_avg': round(1000 * sum(lags) / len(lags), 2),
+              'lag_ms_p99': round(1000 * lags[int(len(lags) * .99)], 2),
+              'lag_ms_max': round(1000 * lags[-1], 2)}
+    print('[Info] Event-loop latency: {}'.format(json.dumps(result)))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--split', default='dev',
+                        choices=[typ.value for typ in DataSetType])
+    parser.add_argument('--data_dir', default=None)
+    args = parser.parse_args()
+    asyncio.run(benchmark_latency(DataSetType(args.split), args.data_dir))
@@ -0,0 +1,103 @@
+import json
+import random
+from collections import defaultdict
+from os import path
+
+from seq2seq import TripleLinearizer
+
+LENGTH_FIELDS = ('target', 'target_txt', 'triples')
+
+# the triples' length is counted in words, without any separator tokens
+_triple_words = TripleLinearizer(head=None, rel=None, tail=None)
+
+
+def record_lengths(record):
+    return {
+        'target': len(record['target'].split()),
+        'target_txt': len(record['target_txt'].split()),
+        'triples': len(_triple_words(record['triples'])),
+    }
+
+
+class LengthBuckets:
+    '''
+    Per-record token lengths of a split, plus the record ids grouped into
+    buckets of `bucket_width` tokens of the `bucket_by` field. Saved next to
+    the split as `<split>.buckets.json`.
+    '''
+
+    def __init__(self, lengths, bucket_by='target', bucket_width=4):
+        self.lengths = lengths
+        self.bucket_by = bucket_by
+        self.bucket_width = bucket_width
+
+        self.buckets = defaultdict(list)
+        for record_ix, length in enumerate(lengths[bucket_by]):
+            self.buckets[length // bucket_width].append(record_ix)
+
+    @classmethod
+    def build(cls, data, bucket_by='target', bucket_width=4):
+        lengths = {field: [] for field in LENGTH_FIELDS}
+        for record in data:
+            for field, length in record_lengths(record).items():
+                lengths[field].append(length)
+        return cls(lengths, bucket_by=bucket_by, bucket_width=bucket_width)
+
+    def save(self, save_dir, data_set_type):
+        bucket_f = path.join(save_dir, data_set_type + '.buckets.json')
+        with open(bucket_f, 'w') as f:
+            json.dump({'bucket_by': self.bucket_by,
+                       'bucket_width': self.bucket_width,
+                       'lengths': self.lengths,
+                       'buckets': {str(k): v for k, v in
+                                   sorted(self.buckets.items())}}, f)
+        return bucket_f
+
+    @classmethod
+    def load(cls, save_dir, data_set_type):
+        with open(path.join(save_dir, data_set_type + '.buckets.json')) as f:
+            saved = json.load(f)
+        return cls(saved['lengths'], bucket_by=saved['bucket_by'],
+                   bucket_width=saved['bucket_width'])
+
+
+class LengthBucketSampler:
+    '''
+    Yields batches of record ids drawn from a single length bucket. Ids are
+    shuffled within buckets and the batches are shuffled across buckets, with
+    a different but reproducible order for each `set_epoch`.
+    '''
+
+    def __init__(self, buckets: LengthBuckets, batch_size, shuffle=True,
+                 drop_last=False, seed=0):
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rand = random.Random(self.seed + self.epoch)
+        batches = []
+        for _, ids in sorted(self.buckets.buckets.items()):
+            ids = list(ids)
+            if self.shuffle:
+                rand.shuffle(ids)
+            for start in range(0, len(ids), self.batch_size):
+                batch = ids[start:start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            rand.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
@@ -0,0 +1,109 @@
+import json
+import struct
+import sys
+from array import array
+from os import path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+GRAPH_ARRAYS = ('nodes', 'node_offsets', 'edges', 'edge_offsets')
+
+
+def write_npy(file_name, arr: array, shape):
+    '''
+    Writes a flat `array.array` in the .npy format, so that it can be
+    memory-mapped with `numpy.load(..., mmap_mode='r')` without numpy being
+    needed for the conversion itself.
+    '''
+    # only used for the signed integer arrays below
+    descr = ('<' if sys.byteorder == 'little' else '>') + 'i' + \
+            str(arr.itemsize)
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(
+        descr, repr(tuple(shape)))
+    # the magic, version, header length and header are padded to 64 bytes
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+    with open(file_name, 'wb') as f:
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)))
+        f.write(header.encode('latin1'))
+        arr.tofile(f)
+
+
+class GraphExporter:
+    '''
+    Writes a split's triples as one CSR-style graph store. For record `i`,
+    its nodes are `nodes[node_offsets[i]:node_offsets[i + 1]]`, entity ids in
+    order of first appearance, and its edges are the (src, rel, dst) rows
+    `edges[edge_offsets[i]:edge_offsets[i + 1]]`, where src/dst index the
+    record's own nodes and rel is a relation id. The entity and relation
+    vocabularies are shared by all splits.
+    '''
+
+    def __init__(self):
+        self.ent2id = {}
+        self.rel2id = {}
+
+    @staticmethod
+    def _id(vocab, key):
+        if key not in vocab:
+            vocab[key] = len(vocab)
+        return vocab[key]
+
+    def save(self, data, save_dir, data_set_type):
+        nodes, node_offsets = array('i'), array('q', [0])
+        edges, edge_offsets = array('i'), array('q', [0])
+        for record in data:
+            ent2local = {}
+            for subj, rel, obj in record['triples']:
+                for ent in (subj, obj):
+                    if ent not in ent2local:
+                        ent2local[ent] = len(ent2local)
+                        nodes.append(self._id(self.ent2id, ent))
+                edges.extend((ent2local[subj], self._id(self.rel2id, rel),
+                              ent2local[obj]))
+            node_offsets.append(len(nodes))
+            edge_offsets.append(len(edges) // 3)
+
+        prefix = path.join(save_dir, data_set_type + '.graph.')
+        write_npy(prefix + 'nodes.npy', nodes, [len(nodes)])
+        write_npy(prefix + 'node_offsets.npy', node_offsets,
+                  [len(node_offsets)])
+        write_npy(prefix + 'edges.npy', edges, [len(edges) // 3, 3])
+        write_npy(prefix + 'edge_offsets.npy', edge_offsets,
+                  [len(edge_offsets)])
+
+    def save_vocab(self, save_dir):
+        for name, vocab in (('entities', self.ent2id),
+                            ('relations', self.rel2id)):
+            with open(path.join(save_dir, 'graph.{}.json'.format(name)),
+                      'w') as f:
+                json.dump(sorted(vocab, key=vocab.get), f, indent=0)
+        print('[Info] Saved graph vocab of {} entities and {} relations into {}'
+              .format(len(self.ent2id), len(self.rel2id), save_dir))
+
+
+class GraphSplit:
+    '''
+    Read side of `GraphExporter`, memory-mapping the arrays with numpy.
+    '''
+
+    def __init__(self, save_dir, data_set_type):
+        if np is None:
+            raise ImportError('numpy is needed to load the graph store')
+        prefix = path.join(save_dir, data_set_type + '.graph.')
+        for name in GRAPH_ARRAYS:
+            setattr(self, name, np.load(prefix + name + '.npy', mmap_mode='r'))
+        with open(path.join(save_dir, 'graph.entities.json')) as f:
+            self.entities = json.load(f)
+        with open(path.join(save_dir, 'graph.relations.json')) as f:
+            self.relations = json.load(f)
+
+    def __len__(self):
+        return len(self.node_offsets) - 1
+
+    def __getitem__(self, record_ix):
+        node_start, node_end = self.node_offsets[record_ix:record_ix + 2]
+        edge_start, edge_end = self.edge_offsets[record_ix:record_ix + 2]
+        return self.nodes[node_start:node_end], self.edges[edge_start:edge_end]
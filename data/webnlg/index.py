@@ -0,0 +1,85 @@
+import json
+import sys
+from array import array
+from collections import defaultdict
+from os import path
+
+
+class InvertedIndex:
+    '''
+    Maps entity and relation names to the positions of the records of a split
+    which use them. Postings are sorted uint32 arrays, all stored back to back
+    in `<split>.postings.bin`; `<split>.index.json` keeps, for each key, the
+    (start, length) of its postings inside that blob.
+    '''
+    KINDS = ('entity', 'relation')
+
+    def __init__(self, postings, key2span, num_records):
+        self.postings = postings
+        self.key2span = key2span
+        self.num_records = num_records
+
+    @classmethod
+    def build(cls, data):
+        key2ids = {kind: defaultdict(list) for kind in cls.KINDS}
+        for record_ix, record in enumerate(data):
+            for subj, rel, obj in record['triples']:
+                for kind, key in (('entity', subj), ('relation', rel),
+                                  ('entity', obj)):
+                    ids = key2ids[kind][key]
+                    if not ids or ids[-1] != record_ix:
+                        ids.append(record_ix)
+
+        postings = array('I')
+        key2span = {kind: {} for kind in cls.KINDS}
+        for kind in cls.KINDS:
+            for key in sorted(key2ids[kind]):
+                ids = key2ids[kind][key]
+                key2span[kind][key] = (len(postings), len(ids))
+                postings.extend(ids)
+        return cls(postings, key2span, len(data))
+
+    def save(self, save_dir, data_set_type):
+        header = {'num_records': self.num_records,
+                  'byteorder': sys.byteorder,
+                  'spans': self.key2span}
+        with open(path.join(save_dir, data_set_type + '.index.json'), 'w') as f:
+            json.dump(header, f)
+        with open(path.join(save_dir, data_set_type + '.postings.bin'),
+                  'wb') as f:
+            self.postings.tofile(f)
+
+    @classmethod
+    def load(cls, save_dir, data_set_type):
+        with open(path.join(save_dir, data_set_type + '.index.json')) as f:
+            header = json.load(f)
+        postings = array('I')
+        with open(path.join(save_dir, data_set_type + '.postings.bin'),
+                  'rb') as f:
+            postings.frombytes(f.read())
+        if header['byteorder'] != sys.byteorder:
+            postings.byteswap()
+        key2span = {kind: {k: tuple(v) for k, v in spans.items()}
+                    for kind, spans in header['spans'].items()}
+        return cls(postings, key2span, header['num_records'])
+
+    def lookup(self, kind, key):
+        start, length = self.key2span[kind].get(key, (0, 0))
+        return self.postings[start:start + length]
+
+    def query(self, entities=(), relations=()):
+        '''
+        Returns the sorted positions of the records using all of `entities`
+        and all of `relations`, e.g. `query(relations=['leaderName'],
+        entities=['Switzerland'])`.
+        '''
+        lists = [self.lookup('entity', e) for e in entities] + \
+                [self.lookup('relation', r) for r in relations]
+        if not lists:
+            return []
+        lists.sort(key=len)
+        result = set(lists[0])
+        for ids in lists[1:]:
+            if not result: break
+            result.intersection_update(ids)
+        return sorted(result)
@@ -0,0 +1,199 @@
+import re
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from matcher import EntityMentionFinder, TokenAutomaton, leftmost_longest
+
+# the entity tags `RDFFileReader.fix_document` puts into templates
+TAG_PATTERN = re.compile(r'\b(?:AGENT|BRIDGE|PATIENT)_\d+\b')
+
+
+def entity_surface(entity, rephrase: Callable = None):
+    '''
+    The text an entity is written as, e.g. "Alan_Bean" -> "Alan Bean", as in
+    `RDFFileReader.fix_sentence`. With `rephrase` (e.g. `rephrase_if_must`),
+    the shortest of its variants is used instead.
+    '''
+    surface = entity.replace('_', ' ')
+    if rephrase is not None:
+        try:
+            variants = [v for v in rephrase(surface) if v.strip()]
+        except ValueError:
+            # e.g. rephrase() on a number with an unknown unit
+            variants = []
+        if variants:
+            surface = min(variants, key=lambda v: (len(v), v))
+    return surface
+
+
+def relexicalize_batch(templates: List[str], ner2ent_list: List[Dict[str, str]],
+                       rephrase: Callable = None) -> List[str]:
+    '''
+    Fills the entity tags of delexicalized templates, e.g. model outputs like
+    "AGENT_1 is located in PATIENT_2 .", with the entities of the matching
+    `ner2ent`. Tags are matched as whole tokens, so PATIENT_1 never replaces
+    the prefix of PATIENT_10; tags missing from `ner2ent` are kept as is.
+    '''
+    if len(templates) != len(ner2ent_list):
+        raise ValueError('{} templates but {} ner2ent'.format(
+            len(templates), len(ner2ent_list)))
+
+    # surface forms are shared by all templates of the batch
+    ent2surface = {}
+
+    def surface(entity):
+        if entity not in ent2surface:
+            ent2surface[entity] = entity_surface(entity, rephrase)
+        return ent2surface[entity]
+
+    outputs = []
+    for template, ner2ent in zip(templates, ner2ent_list):
+        outputs.append(TAG_PATTERN.sub(
+            lambda m: surface(ner2ent[m.group()]) if m.group() in ner2ent
+            else m.group(), template))
+    return outputs
+
+
+def entity_tags(triples):
+    '''
+    Tags the entities of `triples` like the WebNLG templates: AGENT for an
+    entity only used as subject, PATIENT only as object, BRIDGE as both, each
+    kind numbered by order of first appearance (AGENT_1, PATIENT_1, ...).
+    '''
+    subjects = {subj for subj, _, _ in triples}
+    objects = {obj for _, _, obj in triples}
+    ent2tag = {}
+    kind2cnt = defaultdict(int)
+    for subj, _, obj in triples:
+        for ent in (subj, obj):
+            if ent in ent2tag: continue
+            kind = 'BRIDGE' if ent in subjects and ent in objects else \
+                'AGENT' if ent in subjects else 'PATIENT'
+            kind2cnt[kind] += 1
+            ent2tag[ent] = '{}_{}'.format(kind, kind2cnt[kind])
+    return ent2tag
+
+
+class Delexicalizer:
+    '''
+    Builds the `target` template and `ner2ent` of new (triples, text) pairs,
+    which have no WebNLG references, in the same format as the converted
+    records. Entity mentions are found by one automaton per batch over the
+    names and rephrase aliases of the batch's entities. The tokenized aliases
+    are cached for the `max_cached` most recently used entities; pass
+    `entities` to warm that cache.
+    '''
+
+    def __init__(self, nlp, rephrase: Tuple[Callable, Callable] = None,
+                 entities=(), max_cached=100000):
+        if rephrase is None:
+            from utils import rephrase as rephrase_, rephrase_if_must
+            rephrase = (rephrase_, rephrase_if_must)
+        self.nlp = nlp
+        self.finder = EntityMentionFinder(nlp, rephrase)
+        self.ent2forms = OrderedDict()
+        self.max_cached = max_cached
+        for entity in entities:
+            self.surface_forms(entity)
+
+    def surface_forms(self, entity):
+        forms = self.ent2forms.get(entity)
+        if forms is None:
+            forms = self.ent2forms[entity] = self.finder.surface_forms(entity)
+            if len(self.ent2forms) > self.max_cached:
+                self.ent2forms.popitem(last=False)
+        else:
+            self.ent2forms.move_to_end(entity)
+        return forms
+
+    def build(self, entities):
+        automaton = TokenAutomaton()
+        for entity in sorted(entities):
+            for form in self.surface_forms(entity):
+                automaton.add(form.split(), entity)
+        return automaton.build()
+
+    def delexicalize_batch(self, inputs: List[Tuple[list, str]]):
+        '''
+        Takes `[(triples, text), ...]` and returns, for each, a record
+        `{'triples', 'target', 'target_txt', 'ner2ent'}`, or None when no
+        triple has both of its entities mentioned in the text.
+        '''
+        inputs = [([tuple(part.strip().strip('\"') for part in triple)
+                    for triple in triples], text) for triples, text in inputs]
+        automaton = self.build({ent for triples, _ in inputs
+                                for subj, _, obj in triples
+                                for ent in (subj, obj)})
+        return [self.delexicalize(triples, text, automaton)
+                for triples, text in inputs]
+
+    def delexicalize(self, triples, text, automaton: TokenAutomaton = None):
+        if automaton is None:
+            automaton = self.build({ent for subj, _, obj in triples
+                                    for ent in (subj, obj)})
+        text = self.nlp.word_tokenize(text)
+        toks = text.split()
+        ent2tag = entity_tags(triples)
+        mentions = leftmost_longest(
+            m for m in automaton.iter_matches(text.lower().split())
+            if m[2] in ent2tag)
+
+        # as in fix_sentence, keep the triples whose entities are both in
+        # the template, and only tag the entities of those triples
+        mentioned = {ent for _, _, ent in mentions}
+        triples = [t for t in triples if t[0] in mentioned and
+                   t[-1] in mentioned]
+        if not triples:
+            return None
+        triple_entities = {ent for t in triples for ent in (t[0], t[-1])}
+
+        template = []
+        last_end = 0
+        for start, end, ent in mentions:
+            if ent not in triple_entities: continue
+            template += toks[last_end:start] + [ent2tag[ent]]
+            last_end = end
+        template += toks[last_end:]
+
+        return {
+            'triples': triples,
+            'target': ' '.join(template),
+            'target_txt': text,
+            'ner2ent': {ent2tag[ent]: ent for ent in ent2tag
+                        if ent in triple_entities},
+        }
+
+
+def check_delexicalize(delexicalizer: Delexicalizer):
+    '''
+    Regression check that triples whose entities are written with dots, e.g.
+    "U.S." for United_States, are kept and tagged. Returns the failures.
+    '''
+    cases = [
+        ([('Wheeler,_Texas', 'country', 'United_States')],
+         'Wheeler, Texas is a city in the U.S. today.',
+         'AGENT_1 is a city in the PATIENT_1 today .'),
+        ([('St._Louis', 'isPartOf', 'Missouri')],
+         'St. Louis is part of Missouri.', 'AGENT_1 is part of PATIENT_1 .'),
+    ]
+    records = delexicalizer.delexicalize_batch(
+        [(triples, text) for triples, text, _ in cases])
+    failed = []
+    for (triples, text, target), record in zip(cases, records):
+        if record is None or record['target'] != target:
+            failed.append(text)
+            print('[Error] "{}" gave {}, not "{}"'.format(
+                text, record and record['target'], target))
+    print('[Info] {} of {} delexicalization checks passed'.format(
+        len(cases) - len(failed), len(cases)))
+    return failed
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    sys.path.append(os.path.abspath('.'))
+    from utils import NLP
+
+    sys.exit(1 if check_delexicalize(Delexicalizer(NLP())) else 0)
@@ -0,0 +1,173 @@
+from collections import deque
+
+
+class TokenAutomaton:
+    '''
+    Aho-Corasick automaton over token sequences: after `build`, all
+    occurrences of all added patterns in a token list are found in one pass.
+    '''
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    def add(self, tokens, value):
+        node = 0
+        for tok in tokens:
+            nxt = self.goto[node].get(tok)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][tok] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        if tokens and (len(tokens), value) not in self.out[node]:
+            self.out[node].append((len(tokens), value))
+        return self
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for tok, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and tok not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(tok, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+        return self
+
+    def iter_matches(self, tokens):
+        '''
+        Yields (start, end, value) token spans of every (possibly overlapping)
+        pattern occurrence.
+        '''
+        node = 0
+        for tok_ix, tok in enumerate(tokens):
+            while node and tok not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(tok, 0)
+            for length, value in self.out[node]:
+                yield tok_ix + 1 - length, tok_ix + 1, value
+
+
+def leftmost_longest(matches):
+    '''
+    Keeps non-overlapping matches, preferring earlier then longer ones.
+    '''
+    kept = []
+    last_end = 0
+    for start, end, value in sorted(matches, key=lambda m: (m[0], -m[1])):
+        if start >= last_end:
+            kept.append((start, end, value))
+            last_end = end
+    return kept
+
+
+def token_char_spans(text):
+    spans = []
+    pos = 0
+    for tok in text.split():
+        start = text.index(tok, pos)
+        pos = start + len(tok)
+        spans.append((start, pos))
+    return spans
+
+
+class EntityMentionFinder:
+    '''
+    Finds where the entities of `ner2ent` are mentioned in `target_txt`,
+    using one automaton over the surface forms of all entities of a split:
+    the entity name with spaces for underscores, and its `rephrase` /
+    `rephrase_if_must` variants, lowercased and tokenized like the text.
+    '''
+
+    def __init__(self, nlp, rephrase=(None, None)):
+        self.nlp = nlp
+        self.rephrase = [r for r in rephrase if r]
+
+    def surface_forms(self, entity):
+        name = ' '.join(entity.replace('_', ' ').split())
+        forms = {name}
+        for rephrase in self.rephrase:
+            try:
+                # the rephrase tables are lowercased
+                forms |= rephrase(name.lower())
+            except ValueError:
+                # e.g. rephrase() on a number with an unknown unit
+                continue
+        # `target_txt` is tokenized in its own case and lowercased after, and
+        # the tokenizer splits e.g. "st. louis" but not "St. Louis", so the
+        # forms are tokenized cased too, in the casings the text may use
+        return {self.nlp.word_tokenize(cased).lower()
+                for form in forms if form.strip()
+                for cased in {form, form.title(), form.upper()}}
+
+    def build(self, entities):
+        automaton = TokenAutomaton()
+        for entity in sorted(entities):
+            for form in self.surface_forms(entity):
+                automaton.add(form.split(), entity)
+        return automaton.build()
+
+    @staticmethod
+    def find(automaton, record):
+        '''
+        Returns `[[tag, tok_start, tok_end, char_start, char_end], ...]`.
+        '''
+        ent2tag = {ent: tag for tag, ent in record['ner2ent'].items()}
+        text = record['target_txt']
+        matches = [m for m in automaton.iter_matches(text.lower().split())
+                   if m[2] in ent2tag]
+        char_spans = token_char_spans(text)
+        return [[ent2tag[ent], start, end, char_spans[start][0],
+                 char_spans[end - 1][1]]
+                for start, end, ent in leftmost_longest(matches)]
+
+    def annotate(self, data):
+        automaton = self.build({ent for record in data
+                                for ent in record['ner2ent'].values()})
+        for record in data:
+            record['mentions'] = self.find(automaton, record)
+        return data
+
+
+# entities which the tokenizer splits differently once lowercased
+DOTTED_ENTITIES = [
+    ('St._Louis', 'St. Louis is on the Mississippi.'),
+    ('Washington,_D.C.', 'He was born in Washington, D.C. in 1950.'),
+    ('A.C._Cesena', 'A.C. Cesena play in Serie B.'),
+    ('United_States', 'The airport is in the U.S. now.'),
+]
+
+
+def check_dotted_entities(finder: EntityMentionFinder):
+    '''
+    Regression check that entities with dots in their name or aliases are
+    found in text tokenized as `target_txt` is. Returns the missed entities.
+    '''
+    missed = []
+    for entity, text in DOTTED_ENTITIES:
+        record = {'ner2ent': {'AGENT_1': entity},
+                  'target_txt': finder.nlp.word_tokenize(text)}
+        if not finder.find(finder.build([entity]), record):
+            missed.append(entity)
+            print('[Error] {} is not found in "{}"'.format(
+                entity, record['target_txt']))
+    print('[Info] {} of {} dotted entities found'.format(
+        len(DOTTED_ENTITIES) - len(missed), len(DOTTED_ENTITIES)))
+    return missed
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    sys.path.append(os.path.abspath('.'))
+    from utils import NLP, rephrase, rephrase_if_must
+
+    finder = EntityMentionFinder(NLP(), (rephrase, rephrase_if_must))
+    sys.exit(1 if check_dotted_entities(finder) else 0)
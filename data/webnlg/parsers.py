@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+from os import path
+
+try:
+    import xmltodict
+except ImportError:
+    xmltodict = None
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+def element_to_dict(elem):
+    '''
+    Converts an ElementTree/lxml element into what `xmltodict.parse` gives
+    for it: attributes as '@name', a single child as is and repeated children
+    as a list, text as '#text' next to attributes/children, otherwise the
+    bare text, and None for an empty element.
+    '''
+    dic = {'@' + k: v for k, v in elem.attrib.items()}
+    texts = [elem.text] if elem.text else []
+    for child in elem:
+        if not isinstance(child.tag, str):
+            # lxml comments and processing instructions
+            if child.tail: texts.append(child.tail)
+            continue
+        value = element_to_dict(child)
+        if child.tag in dic:
+            if not isinstance(dic[child.tag], list):
+                dic[child.tag] = [dic[child.tag]]
+            dic[child.tag].append(value)
+        else:
+            dic[child.tag] = value
+        if child.tail: texts.append(child.tail)
+
+    text = ''.join(texts).strip() or None
+    if not dic:
+        return text
+    if text is not None:
+        dic['#text'] = text
+    return dic
+
+
+def parse_etree(content):
+    root = ElementTree.fromstring(content.encode('utf-8'))
+    return {root.tag: element_to_dict(root)}
+
+
+def parse_lxml(content):
+    root = lxml_etree.fromstring(content.encode('utf-8'),
+                                 parser=lxml_etree.XMLParser(huge_tree=True))
+    return {root.tag: element_to_dict(root)}
+
+
+def parse_xmltodict(content):
+    return xmltodict.parse(content)
+
+
+BACKENDS = {'lxml': parse_lxml, 'etree': parse_etree,
+            'xmltodict': parse_xmltodict}
+
+
+def available_backends():
+    return [name for name, module in (('lxml', lxml_etree),
+                                      ('etree', ElementTree),
+                                      ('xmltodict', xmltodict)) if module]
+
+
+def get_parser(backend=None):
+    '''
+    Returns the `parse(content) -> dict` function of `backend`, by default
+    the fastest one installed: lxml, then the standard library's ElementTree.
+    '''
+    backend = backend or available_backends()[0]
+    if backend not in available_backends():
+        raise ValueError(backend + " is not available")
+    return BACKENDS[backend]
+
+
+def check_parity(files, backends):
+    mismatches = 0
+    for file_name in files:
+        with open(file_name, encoding="utf-8") as f:
+            content = f.read()
+        # round trip through json-like dicts, as xmltodict may use OrderedDict
+        results = {b: repr(to_plain(get_parser(b)(content))) for b in backends}
+        if len(set(results.values())) != 1:
+            mismatches += 1
+            print('[Error] Backends {} disagree on {}'.format(backends,
+                                                               file_name))
+    print('[Info] Parity of {} over {} files: {} mismatches'.format(
+        backends, len(files), mismatches))
+    return mismatches
+
+
+def to_plain(obj):
+    if isinstance(obj, dict):
+        return {k: to_plain(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_plain(v) for v in obj]
+    return obj
+
+
+def benchmark(files, backends, repeat=3):
+    contents = []
+    for file_name in files:
+        with open(file_name, encoding="utf-8") as f:
+            contents.append(f.read())
+    num_bytes = sum(len(c.encode('utf-8')) for c in contents)
+
+    for backend in backends:
+        parse = get_parser(backend)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for content in contents:
+                parse(content)
+        seconds = (time.perf_counter() - start) / repeat
+        print('[Info] {}: {:.4f}s per pass, {:.1f} MB/s'.format(
+            backend, seconds, num_bytes / seconds / 1e6 if seconds else 0))
+
+
+def raw_files(raw_dir):
+    return sorted(path.join(root, f) for root, _, fs in os.walk(raw_dir)
+                  for f in fs if f.endswith('.xml'))
+
+
+def main(args):
+    files = raw_files(args.raw_dir)
+    backends = args.backends.split(',') if args.backends \
+        else available_backends()
+    mismatches = check_parity(files, backends)
+    benchmark(files, backends, repeat=args.repeat)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_dir', default=path.join(
+        path.dirname(path.realpath(__file__)), 'raw'))
+    parser.add_argument('--backends', default=None,
+                        help='comma separated, default: all installed')
+    parser.add_argument('--repeat', default=3, type=int)
+    main(parser.parse_args())
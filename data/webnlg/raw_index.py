@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import re
+import socket
+from os import path
+
+ENTRY_START = re.compile(rb'<entry\b[^>]*?\beid="([^"]*)"[^>]*>')
+ENTRY_END = b'</entry>'
+
+
+def scan_entries(content: bytes):
+    '''
+    Returns {eid: [start, end]}, the byte range of each `<entry>` element.
+    '''
+    eid2span = {}
+    pos = 0
+    while True:
+        match = ENTRY_START.search(content, pos)
+        if match is None: break
+        end = content.index(ENTRY_END, match.end()) + len(ENTRY_END)
+        eid2span[match.group(1).decode('utf-8')] = [match.start(), end]
+        pos = end
+    return eid2span
+
+
+class RawIndex:
+    '''
+    Byte offsets of every entry of the raw xml files, persisted as
+    `raw.index.json` next to `raw/`. A file's offsets are rebuilt whenever
+    its sha256 changes, e.g. after `Cleaner` rewrote it or after a download;
+    the hash is only recomputed when the file's size or mtime changed.
+    '''
+
+    def __init__(self, raw_dir):
+        self.raw_dir = path.realpath(raw_dir)
+        self.index_f = self.raw_dir + '.index.json'
+        self.files = {}
+        self.changed = False
+        if path.isfile(self.index_f):
+            with open(self.index_f) as f:
+                self.files = json.load(f)
+
+    def key(self, file_name):
+        return path.relpath(path.realpath(file_name), self.raw_dir)
+
+    def entries(self, file_name):
+        key = self.key(file_name)
+        stat = os.stat(file_name)
+        cached = self.files.get(key)
+        # unchanged size and mtime means unchanged file, no need to hash it
+        if cached and cached['size'] == stat.st_size and \
+                cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['entries']
+
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if not cached or cached['sha256'] != sha256:
+            cached = {'sha256': sha256, 'entries': scan_entries(content)}
+        cached.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        self.files[key] = cached
+        self.changed = True
+        return cached['entries']
+
+    def build(self, file_names):
+        '''
+        Indexes `file_names` and saves the index once, if any file was
+        (re)indexed. A file with a cut-off <entry> is left out; reading its
+        entries raises, and the reader reports it.
+        '''
+        for file_name in file_names:
+            try:
+                self.entries(file_name)
+            except ValueError:
+                pass
+        if self.changed:
+            self.save()
+        return self
+
+    def save(self):
+        # written aside and renamed, as several processes may save it at once
+        tmp_f = '{}.{}-{}.tmp'.format(self.index_f, socket.gethostname(),
+                                      os.getpid())
+        with open(tmp_f, 'w') as f:
+            json.dump(self.files, f)
+        os.replace(tmp_f, self.index_f)
+        self.changed = False
+
+    def read_entries(self, file_name, eids):
+        '''
+        Reads only the given entries of `file_name`, wrapped so that they
+        parse into the same `benchmark/entries/entry` structure as the file.
+        '''
+        eid2span = self.entries(file_name)
+        missing = [eid for eid in eids if eid not in eid2span]
+        if missing:
+            raise KeyError('{} has no entries {}'.format(file_name, missing))
+
+        parts = [b'<benchmark><entries>']
+        with open(file_name, 'rb') as f:
+            for start, end in sorted(eid2span[eid] for eid in eids):
+                f.seek(start)
+                parts.append(f.read(end - start))
+        parts.append(b'</entries></benchmark>')
+        return b''.join(parts).decode('utf-8')
@@ -2,102 +2,143 @@ import argparse
 import os
 import sys
 import json
-from itertools import chain
-from os import listdir, path
+import hashlib
+import time
+from itertools import chain, islice
+from multiprocessing import Pool
+from os import path
 from os.path import isdir
 from collections import defaultdict
 
-try:
-    import xmltodict
-except ImportError:
-    os.system('pip install xmltodict')
-    import xmltodict
-
 sys.path.append(os.path.abspath('.'))
 from utils import DataSetType, DataReader, Cleaner, \
     misspelling, rephrase, rephrase_if_must, fix_tokenize, fix_template_word, \
-    NLP, shell, flatten_list, show_var, fwrite
+    NLP, TokenizationCache, Deduplicator, EntrySampler, ErrorLog, ConversionError, \
+    parse_triple, unquote_triple, \
+    shell, flatten_list, show_var, fwrite, \
+    fwrite_compressed, available_compressions, COMPRESSION_EXTS, FileProfiler, \
+    ProgressBar, JsonLinesEventLog
+from index import InvertedIndex
+from seq2seq import Seq2SeqExporter
+from graph import GraphExporter
+from buckets import LengthBuckets
+from stats import DatasetStats, show_stats
+from raw_index import RawIndex
+from parsers import get_parser, available_backends
+from matcher import EntityMentionFinder
+from shards import parse_shard, plan_hash, assign_chunks, save_partial, \
+    load_partials
 
 
 class RDFFileReader:
-    def __init__(self, file_name, verbose=False):
+    def __init__(self, file_name, verbose=False, nlp: NLP = None, eids=None,
+                 raw_index: RawIndex = None, xml_backend=None,
+                 errors: ErrorLog = None, sampler: EntrySampler = None,
+                 on_entry=None):
         self.cleaner = Cleaner()
         self.cleaner.clean(file_name)
 
-        self.nlp = NLP()
+        self.nlp = nlp or NLP()
+        file_key = '/'.join(file_name.rsplit('/', 3)[1:])
+        self.nlp.prefetch(file_key)
 
         self.data = []
         self.file_name = file_name
+        self.verbose = verbose
+        self.drops = []
+        # without an error log, e.g. when used as a library, failures raise
+        self.errors = errors if errors is not None else ErrorLog(strict=True)
 
         self.cnt_dirty_data = 0
         self.cnt_corefs = 0
 
-        with open(file_name, encoding="utf-8") as f:
-            content = f.read()
+        if eids is not None and raw_index is not None:
+            # seek to the requested entries instead of parsing the whole file
+            content = raw_index.read_entries(file_name, eids)
+        else:
+            with open(file_name, encoding="utf-8") as f:
+                content = f.read()
 
         try:
-            structure = xmltodict.parse(content)
-        except:
-            show_var(['file_name'])
-            import pdb;
-            pdb.set_trace()
-        for entry_ix, entry in enumerate(
-                self._triples_from_obj(
-                    structure["benchmark"]["entries"], "entry")):
+            structure = get_parser(xml_backend)(content)
+            entries = self._triples_from_obj(
+                structure["benchmark"]["entries"], "entry")
+        except Exception as e:
+            self.errors.record(file_name, None, e)
+            entries = []
+        for entry_ix, entry in enumerate(entries):
+            if eids is not None and entry['@eid'] not in eids: continue
+            if sampler is not None:
+                if sampler.done: break
+                # sampled before any tokenization is spent on the entry
+                if not sampler.keep(file_key, entry['@eid']): continue
             self.entry_ix = entry['@eid']
-
-            triplets = [tuple(map(str.strip, r.split("|")))
-                        for r in self._triples_from_obj(
-                    entry["modifiedtripleset"], "mtriple")]
-
-            entitymaps = dict([tuple(map(str.strip, entitymap.split("|")))
-                               for entitymap in self._triples_from_obj(
-                    entry['entitymap'], 'entity')])
-
-            sentences = list(self.extract_sentences(entry["lex"]))
-
-            for s_tripleset, text, template, ner2ent in sentences:
-                self.data.append(
-                    {
-                        # 'rdfs': triplets,
-                        'triples': s_tripleset,
-                        'target': template,
-                        'target_txt': text,
-                        'ner2ent': ner2ent,
-                    })
+            try:
+                records = self.read_entry(entry)
+            except Exception as e:
+                # the entry's records are only kept if all of its lex succeed
+                self.errors.record(file_name, self.entry_ix, e)
+                continue
+            self.data += records
+            if sampler is not None: sampler.add(len(records))
+            if on_entry is not None: on_entry(self.entry_ix, len(records))
         if verbose and self.cnt_dirty_data: show_var(["self.cnt_dirty_data"])
         if verbose and self.cnt_corefs: show_var(["self.cnt_corefs"])
 
+    def read_entry(self, entry):
+        triplets = [parse_triple(r) for r in self._triples_from_obj(
+            entry["modifiedtripleset"], "mtriple")]
+
+        entitymaps = dict(parse_triple(entitymap)
+                          for entitymap in self._triples_from_obj(
+            entry['entitymap'], 'entity'))
+
+        sentences = list(self.extract_sentences(entry["lex"]))
+
+        return [
+            {
+                # 'rdfs': triplets,
+                'triples': s_tripleset,
+                'target': template,
+                'target_txt': text,
+                'ner2ent': ner2ent,
+            } for s_tripleset, text, template, ner2ent in sentences]
+
     @staticmethod
     def _triples_from_obj(obj, t_name):
-        def _triples_fix(triplets):
-            if not isinstance(triplets, list):
-                return [triplets]
-            else:
-                return map(lambda t: t, triplets)
-
-        if not isinstance(obj, list):
-            if obj is not None:
-                if t_name in obj:
-                    return _triples_fix(obj[t_name])
+        # xmltodict gives a single child as is, and repeated children as a list
+        if isinstance(obj, list):
+            return [o[t_name] if isinstance(o[t_name], list) else [o[t_name]]
+                    for o in obj]
+        if obj is None or t_name not in obj:
             return []
-        else:
-            return [_triples_fix(o[t_name]) for o in obj]
+        triplets = obj[t_name]
+        return triplets if isinstance(triplets, list) else [triplets]
+
+    def drop(self, reason, **details):
+        drop = {'file': self.file_name, 'eid': self.entry_ix,
+                'lid': self.lex_id, 'reason': reason}
+        drop.update(details)
+        self.drops.append(drop)
+        if self.verbose:
+            print('[Info] Dropped {}'.format(json.dumps(drop)))
 
     def extract_sentences(self, lex):
         sentences = lex
         if not isinstance(sentences, list): sentences = [sentences]
 
         for s in sentences:
-            if s['@comment'] == 'bad': continue
+            self.lex_id = s.get('@lid')
+            if s['@comment'] == 'bad':
+                self.drop('lex is commented as bad')
+                continue
 
             template = s['template']
             text = s['text']
             tag2ent = dict([(r['@tag'], r['@entity']) for r in
                             self._triples_from_obj(s['references'],
                                                    'reference')])
-            s_tripleset_raw = [[tuple(map(str.strip, r.split("|")))
-                                for r in
+            s_tripleset_raw = [[parse_triple(r) for r in
                                 self._triples_from_obj(s_triples, 'striple')]
                                for s_triples in
                                self._triples_from_obj(s["sortedtripleset"],
@@ -119,6 +160,10 @@ class RDFFileReader:
                 # import pdb;
                 # pdb.set_trace()
                 self.cnt_dirty_data += 1
+                self.drop('{} template sentences, {} text sentences and {} '
+                          'sorted triple sets do not align'.format(
+                    len(template), len(text), len(s_tripleset)),
+                    template=template, text=text, triples=s_tripleset)
                 continue
 
             for s_t, tex, tem in zip(s_tripleset, text, template):
@@ -128,6 +173,9 @@ class RDFFileReader:
                 if not (new_s_t and tem and tex and uniq_tag2ent):
                     self.cnt_corefs += 1
                     # import pdb;pdb.set_trace()
+                    self.drop('no triple of the sentence has both entities '
+                              'tagged in its template', template=tem,
+                              text=tex, triples=s_t)
                     continue
 
                 yield new_s_t, tex, tem, uniq_tag2ent
@@ -149,6 +197,8 @@ class RDFFileReader:
 
         if (not tag2ent) or (not s_tripleset):
             self.cnt_dirty_data += not tag2ent
+            self.drop('lex has no references' if not tag2ent else
+                      'lex has no sorted triples', template=template, text=text)
             return None
 
         # fix this case "same entity has different ners BRIDGE-1 PATIENT-1"
@@ -169,13 +219,8 @@ class RDFFileReader:
 
         # clean out extra quotes around entity names
         uniq_tag2ent = {k: v.strip('\"') for k, v in uniq_tag2ent.items()}
-        try:
-            s_tripleset = [[(subj.strip('\"'), predi, obj.strip('\"'))
-                            for subj, predi, obj in s_triples]
-                           for s_triples in s_tripleset]
-        except:
-            import pdb;
-            pdb.set_trace()
+        s_tripleset = [[unquote_triple(triple) for triple in s_triples]
+                       for s_triples in s_tripleset]
 
         # replaces '-' with '_' only in entity types
         tags = set(uniq_tag2ent.keys())
@@ -245,52 +290,779 @@ class RDFFileReader:
         return s_tripleset, template, tag2tri_ent
 
 
+_worker = {}
+
+
+def _init_worker(cache_path, xml_backend, strict, sampler, raw_dir, nlp=None):
+    if nlp is None:
+        cache = TokenizationCache(cache_path) if cache_path else None
+        nlp = NLP(cache=cache)
+    _worker.update(nlp=nlp, xml_backend=xml_backend,
+                   strict=strict, sampler=sampler, raw_index=RawIndex(raw_dir))
+
+
+def _convert_chunk(task):
+    file_ix, chunk_ix, file_name, eids = task
+    errors = ErrorLog(strict=_worker['strict'])
+    entries = []
+    start = time.perf_counter()
+    rdf = RDFFileReader(file_name, nlp=_worker['nlp'],
+                        eids=set(eids) if eids is not None else None,
+                        raw_index=_worker['raw_index'],
+                        xml_backend=_worker['xml_backend'], errors=errors,
+                        sampler=_worker['sampler'],
+                        on_entry=lambda eid, n: entries.append((eid, n)))
+    cache = _worker['nlp'].cache
+    cache_counts = (0, 0)
+    if cache is not None:
+        cache.flush()
+        cache_counts = (cache.cnt_hits, cache.cnt_misses)
+        cache.cnt_hits = cache.cnt_misses = 0
+    return file_ix, chunk_ix, rdf.data, entries, errors.errors, \
+        cache_counts, time.perf_counter() - start
+
+
 class WebNLGDataReader(DataReader):
-    def __init__(self, set: DataSetType):
+    def __init__(self, set: DataSetType, dedup: Deduplicator = None,
+                 data_dir=None, file_cache=None, profiler: FileProfiler = None,
+                 nlp: NLP = None, xml_backend=None, errors: ErrorLog = None,
+                 mentions=False, sampler: EntrySampler = None, callbacks=(),
+                 workers=1, chunk_size=50, shard=None, merge=False):
         self.data_set_type = set.value
-        files = self.recurse_files(
-            path.join(path.dirname(path.realpath(__file__)), "raw", set.value))
-        data = flatten_list([RDFFileReader(f).data for f in files])
+        self.split_name = 'valid' if set.value == 'dev' else set.value
+        self.stats = None
+        self.callbacks = list(callbacks)
+        self.sampler = sampler
+        self.xml_backend = xml_backend
+        self.errors = errors
+        # one spaCy pipeline for all files instead of loading it per file
+        self.nlp = nlp or NLP()
+        self.data_dir = data_dir or path.dirname(path.realpath(__file__))
+        self.file_cache = file_cache
+        self.profiler = profiler
+        file_sizes = [] if merge else \
+            self.scan_files(path.join(self.data_dir, "raw", set.value))
+        self.emit('split_started', split=set.value, files=len(file_sizes),
+                  bytes=sum(size for _, size in file_sizes))
+        if merge:
+            chunks, errors, self.stats = load_partials(self.data_dir,
+                                                       self.split_name)
+            if self.errors is not None:
+                self.errors.errors += errors
+            if dedup is not None and dedup.remove:
+                self.stats = None  # the shards' stats include the duplicates
+            data = chain.from_iterable(chunks)
+        elif shard is not None:
+            data = chain.from_iterable(
+                self.read_shard(file_sizes, shard, workers, chunk_size))
+        # a --limit subset and per-file profiles need the files one by one
+        elif workers > 1 and profiler is None and \
+                (sampler is None or sampler.limit is None):
+            data = chain.from_iterable(
+                self.read_files_parallel(file_sizes, workers, chunk_size))
+        else:
+            # lazily, so that no more files are opened once the sampler is done
+            data = chain.from_iterable(self.read_file(f) for f, _ in file_sizes
+                                       if sampler is None or not sampler.done)
+        if dedup is not None:
+            data = dedup.filter(data, set.value)
+        if sampler is not None and sampler.limit is not None:
+            data = islice(data, sampler.limit)
+        data = list(data)
+
+        self.emit('split_finished', split=set.value, records=len(data))
 
         super().__init__(data, misspelling=misspelling,
                          rephrase=(rephrase, rephrase_if_must))
 
-    def recurse_files(self, folder):
-        if isdir(folder):
-            return flatten_list(
-                [self.recurse_files(folder + '/' + f) for f in listdir(folder)
-                 if not f.startswith('.')])
-        return [folder]
+        if mentions:
+            EntityMentionFinder(self.nlp, self.rephrase).annotate(self.data)
+
+    def emit(self, event, **info):
+        for callback in self.callbacks:
+            callback(event, **info)
+
+    def read_file(self, file_name):
+        num_bytes = path.getsize(file_name)
+        self.emit('file_started', file=file_name, bytes=num_bytes)
+        start = time.perf_counter()
+        self.file_entries = 0
+        data = self._read_file(file_name)
+        self.emit('file_finished', file=file_name, bytes=num_bytes,
+                  entries=self.file_entries, records=len(data),
+                  seconds=round(time.perf_counter() - start, 4))
+        return data
+
+    def on_entry(self, eid, num_records):
+        self.file_entries += 1
+        self.emit('entry', eid=eid, records=num_records)
+
+    def _read_file(self, file_name):
+        if self.file_cache is None:
+            return self.convert_file(file_name)
+
+        key = self.cache_key(file_name)
+        if key not in self.file_cache:
+            self.file_cache[key] = self.convert_file(file_name)
+        return self.file_cache[key]
+
+    @staticmethod
+    def cache_key(file_name):
+        # byte-identical files (e.g. across versions) are converted only once
+        with open(file_name, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        return '/'.join(file_name.rsplit('/', 3)[1:]), content_hash
+
+    def plan_chunks(self, file_sizes, chunk_size):
+        '''
+        Splits the files into chunks of `chunk_size` entries by their byte
+        offsets in the raw index. Returns the chunks as
+        [(file_ix, chunk_ix, file_name, eids)] in file and entry order, their
+        sizes in bytes, and the raw index.
+        '''
+        cleaner = Cleaner()
+        for file_name, _ in file_sizes:
+            # before the offsets are taken, and before workers read the files
+            cleaner.clean(file_name)
+        raw_index = RawIndex(path.join(self.data_dir, 'raw')).build(
+            file_name for file_name, _ in file_sizes)
+
+        tasks, chunk_bytes = [], []
+        for file_ix, (file_name, num_bytes) in enumerate(file_sizes):
+            try:
+                eid2span = raw_index.entries(file_name)
+            except ValueError:  # an <entry> is cut off
+                eid2span = {}
+            eids = list(eid2span)
+            # a file without (readable) entries goes through the reader whole,
+            # so that its parse error is recorded like in a serial run
+            chunks = [eids[i:i + chunk_size]
+                      for i in range(0, len(eids), chunk_size)] or [None]
+            for chunk_ix, chunk in enumerate(chunks):
+                tasks.append((file_ix, chunk_ix, file_name, chunk))
+                chunk_bytes.append(num_bytes if chunk is None else sum(
+                    eid2span[eid][1] - eid2span[eid][0] for eid in chunk))
+        return tasks, chunk_bytes, raw_index
+
+    def run_chunks(self, tasks, file_sizes, workers, raw_index):
+        '''
+        Converts the chunks on `workers` processes (in this one if 1), those of
+        the largest files first, so that one big file is spread over all
+        workers instead of finishing last on one of them. Yields
+        (file_ix, chunk_ix, records, entries, errors) as chunks finish, and
+        emits the same file and entry events as `read_file`: `file_started`
+        with the first chunk of a file back, `file_finished` with the last.
+        '''
+        by_size = sorted(range(len(file_sizes)),
+                         key=lambda file_ix: -file_sizes[file_ix][1])
+        rank = {file_ix: r for r, file_ix in enumerate(by_size)}
+        tasks = sorted(tasks, key=lambda task: (rank[task[0]], task[1]))
+        left = defaultdict(int)
+        for task in tasks:
+            left[task[0]] += 1
+        file2entries = defaultdict(int)
+        file2records = defaultdict(int)
+        # the file's own conversion time, summed over its chunks' workers
+        file2seconds = defaultdict(float)
+
+        cache = self.nlp.cache
+        initargs = (cache.db_path if cache is not None else None,
+                    self.xml_backend, self.errors is None or self.errors.strict,
+                    self.sampler, raw_index.raw_dir)
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=initargs)
+            results = pool.imap_unordered(_convert_chunk, tasks)
+        else:
+            pool = None
+            _init_worker(*initargs, nlp=self.nlp)
+            results = map(_convert_chunk, tasks)
+        try:
+            for file_ix, chunk_ix, records, entries, errors, cache_counts, \
+                    seconds in results:
+                if cache is not None:
+                    cache.cnt_hits += cache_counts[0]
+                    cache.cnt_misses += cache_counts[1]
+                file_name, num_bytes = file_sizes[file_ix]
+                if file_ix not in file2seconds:
+                    self.emit('file_started', file=file_name, bytes=num_bytes)
+                for eid, num_records in entries:
+                    self.emit('entry', eid=eid, records=num_records)
+                file2entries[file_ix] += len(entries)
+                file2records[file_ix] += len(records)
+                file2seconds[file_ix] += seconds
+                left[file_ix] -= 1
+                if not left[file_ix]:
+                    self.emit('file_finished', file=file_name, bytes=num_bytes,
+                              entries=file2entries[file_ix],
+                              records=file2records[file_ix],
+                              seconds=round(file2seconds[file_ix], 4))
+                yield file_ix, chunk_ix, records, entries, errors
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def read_files_parallel(self, file_sizes, workers, chunk_size):
+        '''
+        Converts the files with `run_chunks` in chunks of `chunk_size`
+        entries. The records come back per file, in file and entry order, the
+        same as from `read_file`.
+        '''
+        tasks, _, raw_index = self.plan_chunks(file_sizes, chunk_size)
+
+        file2chunks, file2key = [], []
+        for file_ix, (file_name, num_bytes) in enumerate(file_sizes):
+            key = self.cache_key(file_name) \
+                if self.file_cache is not None else None
+            file2key.append(key)
+            if key in (self.file_cache or {}):
+                file2chunks.append([self.file_cache[key]])
+                self.emit('file_started', file=file_name, bytes=num_bytes)
+                self.emit('file_finished', file=file_name, bytes=num_bytes,
+                          entries=0, records=len(self.file_cache[key]),
+                          seconds=0.)
+            else:
+                file2chunks.append([None] * sum(
+                    task[0] == file_ix for task in tasks))
+        tasks = [task for task in tasks if None in file2chunks[task[0]]]
+
+        chunk2errors = {}
+        for file_ix, chunk_ix, records, _, errors in self.run_chunks(
+                tasks, file_sizes, workers, raw_index):
+            file2chunks[file_ix][chunk_ix] = records
+            chunk2errors[file_ix, chunk_ix] = errors
+
+        if self.errors is not None:
+            for chunk in sorted(chunk2errors):
+                self.errors.errors += chunk2errors[chunk]
+
+        file2data = [list(chain.from_iterable(chunks))
+                     for chunks in file2chunks]
+        if self.file_cache is not None:
+            for key, data in zip(file2key, file2data):
+                self.file_cache[key] = data
+        return file2data
+
+    def read_shard(self, file_sizes, shard, workers, chunk_size):
+        '''
+        Converts the chunks which `assign_chunks` gives to `shard` = (i, N),
+        keeping them in `self.partial` for `save_partial`. Every node plans
+        the same chunks from the same raw data, so the shards never overlap.
+        '''
+        tasks, chunk_bytes, raw_index = self.plan_chunks(file_sizes,
+                                                         chunk_size)
+        file_keys = [self.cache_key(file_name) for file_name, _ in file_sizes]
+        sampler = self.sampler or EntrySampler()
+        plan_key = plan_hash(
+            [list(file_keys[file_ix]) + [eids]
+             for file_ix, _, _, eids in tasks],
+            {'sample': sampler.fraction, 'seed': sampler.seed,
+             'xml_backend': self.xml_backend})
+
+        shard_ix, num_shards = shard
+        shard_of = assign_chunks(chunk_bytes, num_shards)
+        task2chunk = {task[:2]: chunk_ix for chunk_ix, task in enumerate(tasks)}
+        chunk2records, errors = {}, []
+        for file_ix, chunk_ix, records, _, chunk_errors in self.run_chunks(
+                [task for task, s in zip(tasks, shard_of) if s == shard_ix],
+                file_sizes, workers, raw_index):
+            chunk_ix = task2chunk[file_ix, chunk_ix]
+            chunk2records[chunk_ix] = records
+            errors += [dict(error, chunk=chunk_ix) for error in chunk_errors]
+        errors.sort(key=lambda error: error['chunk'])
+        if self.errors is not None:
+            self.errors.errors += [{k: v for k, v in error.items()
+                                    if k != 'chunk'} for error in errors]
+
+        chunks = sorted(chunk2records.items())
+        self.partial = (shard_ix, num_shards, plan_key, len(tasks), chunks,
+                        errors)
+        return [records for _, records in chunks]
+
+    def save_partial(self):
+        shard_ix, num_shards, plan_key, num_chunks, chunks, errors = \
+            self.partial
+        save_partial(self.data_dir, self.split_name, shard_ix, num_shards,
+                     plan_key, num_chunks, chunks, errors,
+                     stats=DatasetStats().update_all(self.data))
 
-    def save(self):
-        writeout = json.dumps(self.data, indent=4)
-        data_set_type = 'valid' if self.data_set_type == 'dev' else self.data_set_type
-        save_f = path.join(path.dirname(path.realpath(__file__)),
-                           data_set_type + '.json')
+    def convert_file(self, file_name):
+        def read():
+            return RDFFileReader(file_name, nlp=self.nlp,
+                                 xml_backend=self.xml_backend,
+                                 errors=self.errors,
+                                 sampler=self.sampler,
+                                 on_entry=self.on_entry).data
 
-        fwrite(writeout, save_f)
+        if self.profiler is not None:
+            return self.profiler.run(file_name, read)
+        return read()
+
+    @staticmethod
+    def scan_files(folder):
+        '''
+        Returns [(file_name, size)] of all files under `folder`, sorted by
+        name, from one `os.scandir` walk which also yields the sizes.
+        '''
+        if not isdir(folder):
+            return [(folder, path.getsize(folder))]
+        file_sizes = []
+        folders = [folder]
+        while folders:
+            with os.scandir(folders.pop()) as it:
+                for entry in it:
+                    if entry.name.startswith('.'): continue
+                    if entry.is_dir():
+                        folders.append(entry.path)
+                    else:
+                        file_sizes.append((entry.path, entry.stat().st_size))
+        return sorted(file_sizes)
+
+    @classmethod
+    def recurse_files(cls, folder):
+        return [file_name for file_name, _ in cls.scan_files(folder)]
+
+    def save(self, num_shards=1, balance='records', index=False,
+             seq2seq: Seq2SeqExporter = None, compression=None,
+             buckets=False, stats=False, graph: GraphExporter = None):
+        data_set_type = self.split_name
+        save_dir = self.data_dir
+        if seq2seq is not None:
+            seq2seq.save(self.data, save_dir, data_set_type)
+        if graph is not None:
+            graph.save(self.data, save_dir, data_set_type)
+        if index:
+            InvertedIndex.build(self.data).save(save_dir, data_set_type)
+            print('[Info] Saved inverted index of {} into {}'.format(
+                data_set_type, save_dir))
+        if buckets:
+            bucket_f = LengthBuckets.build(self.data).save(save_dir,
+                                                           data_set_type)
+            print('[Info] Saved length buckets of {} into {}'.format(
+                data_set_type, bucket_f))
+        if stats:
+            if self.stats is None:
+                self.stats = DatasetStats().update_all(self.data)
+            self.stats.save(path.join(save_dir, data_set_type + '.stats.json'))
+        if num_shards > 1:
+            self.save_shards(save_dir, data_set_type, num_shards, balance,
+                             compression)
+            return
+
+        save_f = path.join(save_dir, data_set_type + '.json')
+        save_f = self.write_json(self.data, save_f, compression)[0]
         print('[Info] Saved {} data into {}'.format(len(self.data), save_f))
 
+    @staticmethod
+    def write_json(data, save_f, compression=None):
+        if compression is None:
+            writeout = json.dumps(data, indent=4).encode('utf-8')
+            fwrite(writeout, save_f, mode='wb')
+            return save_f, len(writeout), hashlib.sha256(writeout).hexdigest()
+
+        save_f += COMPRESSION_EXTS[compression]
+        num_bytes, sha256 = fwrite_compressed(
+            json.JSONEncoder(indent=4).iterencode(data), save_f, compression)
+        return save_f, num_bytes, sha256
+
+    def save_shards(self, save_dir, data_set_type, num_shards, balance,
+                    compression=None):
+        shards = self.split_shards(self.data, num_shards, balance)
+
+        manifest = {'split': data_set_type, 'num_records': len(self.data),
+                    'num_shards': num_shards, 'balance': balance,
+                    'shards': []}
+        for shard_ix, shard in enumerate(shards):
+            shard_name = '{}-{:05d}-of-{:05d}.json'.format(
+                data_set_type, shard_ix, num_shards)
+            shard_f, num_bytes, sha256 = self.write_json(
+                shard, path.join(save_dir, shard_name), compression)
+            manifest['shards'].append({
+                'file': path.basename(shard_f),
+                'num_records': len(shard),
+                # size and checksum of the uncompressed json
+                'num_bytes': num_bytes,
+                'sha256': sha256,
+            })
+
+        manifest_f = path.join(save_dir, data_set_type + '.manifest.json')
+        fwrite(json.dumps(manifest, indent=4), manifest_f)
+        print('[Info] Saved {} data into {} shards, manifest {}'.format(
+            len(self.data), num_shards, manifest_f))
+
+    @staticmethod
+    def split_shards(data, num_shards, balance='records'):
+        # contiguous shards, so concatenating them gives back the full split
+        if balance == 'records':
+            weights = [1] * len(data)
+        elif balance == 'bytes':
+            weights = [len(json.dumps(d, indent=4).encode('utf-8'))
+                       for d in data]
+        else:
+            raise ValueError(balance + " is unknown")
+
+        total = sum(weights)
+        shards = [[] for _ in range(num_shards)]
+        shard_ix = 0
+        cum = 0
+        for d, weight in zip(data, weights):
+            # move on once this shard has reached its share of the total
+            while shard_ix < num_shards - 1 and \
+                    cum >= total * (shard_ix + 1) / num_shards:
+                shard_ix += 1
+            shards[shard_ix].append(d)
+            cum += weight
+        return shards
+
+
+VERSIONS = ["1.4", "1.5"]
+
+
+def parse_versions(versions: str):
+    versions = versions.split(',')
+    for version in versions:
+        if version not in VERSIONS:
+            raise argparse.ArgumentTypeError('{} is unknown, choose from {}'
+                                             .format(version, VERSIONS))
+    return versions
 
-def download(version: str):
-    cmd = 'rm -rf data/webnlg/raw 2>/dev/null \n' \
+
+def parse_splits(splits: str):
+    return [DataSetType('dev' if split == 'valid' else split)
+            for split in splits.split(',')]
+
+
+def download(version2dir: dict):
+    cmd = 'rm -rf data_webnlg 2>/dev/null \n' \
           'git clone https://github.com/zhijing-jin/webnlg.git data_webnlg\n' \
-          'cd data_webnlg; git checkout e978c3e; cd .. \n' \
-          f'cp -a data_webnlg/data/v{version}/en/ data/webnlg/raw\n' \
-          'rm -rf data_webnlg\n'
-    print(f'[Info] Downloading enriched WebNLG v{version} data...')
+          'cd data_webnlg; git checkout e978c3e; cd .. \n'
+    for version, data_dir in version2dir.items():
+        raw_dir = path.join(data_dir, 'raw')
+        cmd += f'mkdir -p {data_dir}; rm -rf {raw_dir} 2>/dev/null \n' \
+               f'cp -a data_webnlg/data/v{version}/en/ {raw_dir}\n'
+    cmd += 'rm -rf data_webnlg\n'
+    print('[Info] Downloading enriched WebNLG v{} data...'.format(
+        ', v'.join(version2dir)))
     shell(cmd)
 
 
+def prepare(version2dir: dict):
+    '''
+    Cleans the downloaded raw files and indexes their entries once, so that
+    the nodes of a --shard run only read them.
+    '''
+    cleaner = Cleaner()
+    for data_dir in version2dir.values():
+        raw_dir = path.join(data_dir, 'raw')
+        files = WebNLGDataReader.recurse_files(raw_dir)
+        for file_name in files:
+            cleaner.clean(file_name)
+        RawIndex(raw_dir).build(files)
+        print('[Info] Prepared {} raw files in {}'.format(len(files), raw_dir))
+
+
+def convert_shard(args, data_dir, errors=None, nlp=None, callbacks=()):
+    shard = parse_shard(args.shard)
+    for typ in args.splits:
+        sampler = EntrySampler(args.sample, args.seed) \
+            if args.sample < 1 else None
+        data_reader = WebNLGDataReader(typ, data_dir=data_dir,
+                                       xml_backend=args.xml_backend,
+                                       errors=errors, nlp=nlp,
+                                       sampler=sampler, callbacks=callbacks,
+                                       workers=args.workers,
+                                       chunk_size=args.chunk_size,
+                                       shard=shard)
+        data_reader.save_partial()
+
+
+def convert(args, data_dir, file_cache=None, profiler=None, errors=None,
+            nlp=None, callbacks=()):
+    dedup = Deduplicator(remove=args.dedup == 'remove') \
+        if args.dedup != 'off' else None
+
+    seq2seq = Seq2SeqExporter() if args.seq2seq else None
+    graph = GraphExporter() if args.graph else None
+
+    split2data = {}
+    split2stats = {}
+    for typ in args.splits:
+        sampler = EntrySampler(args.sample, args.seed, args.limit) \
+            if args.sample < 1 or args.limit is not None else None
+        data_reader = WebNLGDataReader(typ, dedup=dedup, data_dir=data_dir,
+                                       file_cache=file_cache,
+                                       profiler=profiler,
+                                       xml_backend=args.xml_backend,
+                                       errors=errors, nlp=nlp,
+                                       mentions=args.mentions,
+                                       sampler=sampler,
+                                       callbacks=callbacks,
+                                       workers=args.workers,
+                                       chunk_size=args.chunk_size,
+                                       merge=args.merge)
+        data_reader.save(num_shards=args.num_shards, balance=args.shard_balance,
+                         index=args.index, seq2seq=seq2seq,
+                         compression=args.compression, buckets=args.buckets,
+                         stats=args.stats, graph=graph)
+        split2data[typ.value] = data_reader.data
+        if args.stats:
+            split2stats[data_reader.split_name] = data_reader.stats
+
+    if seq2seq is not None:
+        seq2seq.save_vocab(data_dir)
+    if graph is not None:
+        graph.save_vocab(data_dir)
+
+    if dedup is not None:
+        dedup.report()
+
+    if split2stats:
+        show_stats(split2stats)
+    return split2data
+
+
+def diff_versions(version2data: dict, save_dir, max_examples=20):
+    def record_key(record):
+        return json.dumps(record, sort_keys=True)
+
+    (version_a, data_a), (version_b, data_b) = version2data.items()
+    diff = {'versions': [version_a, version_b], 'splits': {}}
+    for split in data_a:
+        keys_a = {record_key(r) for r in data_a[split]}
+        keys_b = {record_key(r) for r in data_b[split]}
+        only_a = sorted(keys_a - keys_b)
+        only_b = sorted(keys_b - keys_a)
+        diff['splits'][split] = {
+            'common': len(keys_a & keys_b),
+            'only_' + version_a: len(only_a),
+            'only_' + version_b: len(only_b),
+            'examples_only_' + version_a: [json.loads(k) for k in
+                                           only_a[:max_examples]],
+            'examples_only_' + version_b: [json.loads(k) for k in
+                                           only_b[:max_examples]],
+        }
+        print('[Info] {}: {} common records, {} only in v{}, {} only in v{}'
+              .format(split, len(keys_a & keys_b), len(only_a), version_a,
+                      len(only_b), version_b))
+
+    diff_f = path.join(save_dir, 'diff_v{}_v{}.json'.format(version_a,
+                                                            version_b))
+    fwrite(json.dumps(diff, indent=4), diff_f)
+    print('[Info] Saved version diff into {}'.format(diff_f))
+
+
+def debug_entries(only_eids, data_dir=None, xml_backend=None, errors=None,
+                  nlp=None):
+    data_dir = data_dir or path.dirname(path.realpath(__file__))
+    file2eids = defaultdict(set)
+    for spec in only_eids:
+        if ':' not in spec or not spec.rsplit(':', 1)[1]:
+            print('[Error] --only-eid {} is not FILE:EID[,EID...], skipped'
+                  .format(spec))
+            continue
+        file_name, eids = spec.rsplit(':', 1)
+        if not path.isabs(file_name):
+            file_name = path.join(data_dir, 'raw', file_name)
+        file2eids[file_name].update(eids.split(','))
+
+    nlp = nlp or NLP()
+    raw_index = RawIndex(path.join(data_dir, 'raw'))
+    for file_name, eids in file2eids.items():
+        try:
+            eid2span = raw_index.entries(file_name)
+        except (OSError, ValueError) as e:
+            print('[Error] Cannot read the entries of {}: {}'.format(
+                file_name, e))
+            continue
+        missing = sorted(eids - set(eid2span))
+        if missing:
+            print('[Error] {} has no entries {}, skipped'.format(
+                file_name, ','.join(missing)))
+            eids -= set(missing)
+            if not eids: continue
+        rdf = RDFFileReader(file_name, verbose=True, nlp=nlp, eids=eids,
+                            raw_index=raw_index, xml_backend=xml_backend,
+                            errors=errors)
+        for record in rdf.data:
+            print(json.dumps(record))
+        print('[Info] {}: {} records kept, {} lex/sentences dropped from '
+              'entries {}'.format(file_name, len(rdf.data), len(rdf.drops),
+                                  ','.join(sorted(eids))))
+
+
 def main(args):
-    download(args.version)
+    errors = ErrorLog(strict=args.strict)
+    try:
+        run(args, errors)
+    except ConversionError as e:
+        print('[Error] Stopped at the first error (--strict): {}'.format(e))
+        sys.exit(1)
+
+
+def run(args, errors):
+    root_dir = path.dirname(path.realpath(__file__))
+    # SQLite is not safe to share between machines, so each shard has its
+    # own, which the fixed chunk assignment keeps warm across re-runs
+    cache_name = 'tokenize_cache.sqlite' if args.shard is None else \
+        'tokenize_cache.shard-{}-of-{}.sqlite'.format(*parse_shard(args.shard))
+    cache = None if args.no_tokenize_cache else \
+        TokenizationCache(path.join(root_dir, cache_name))
+    nlp = NLP(cache=cache)
+    try:
+        convert_versions(args, errors, nlp)
+    finally:
+        if cache is not None:
+            cache.flush()
+            print('[Info] Tokenization cache: {} hits, {} misses'.format(
+                cache.cnt_hits, cache.cnt_misses))
+
+
+def convert_versions(args, errors, nlp):
+    if args.only_eid:
+        # reads the existing raw/ as is, without downloading it again
+        debug_entries(args.only_eid, xml_backend=args.xml_backend,
+                      errors=errors, nlp=nlp)
+        return
+
+    versions = args.version
+    if (args.shard is not None or args.merge) and args.limit is not None:
+        raise ValueError("--limit depends on the file order, so it cannot "
+                         "be used with --shard or --merge")
+    if args.shard is not None and args.merge:
+        raise ValueError("--shard and --merge are separate runs")
+
+    root_dir = path.dirname(path.realpath(__file__))
+    if len(versions) == 1:
+        version2dir = {versions[0]: root_dir}
+    else:
+        version2dir = {v: path.join(root_dir, 'v' + v) for v in versions}
+    if args.shard is not None:
+        # all nodes read the raw/ prepared once beforehand, none downloads it
+        for data_dir in version2dir.values():
+            if not isdir(path.join(data_dir, 'raw')):
+                raise ValueError('{} has no raw/, run reader.py --prepare '
+                                 'first'.format(data_dir))
+    elif not args.merge:
+        download(version2dir)
+    if args.prepare:
+        prepare(version2dir)
+        return
+
+    # a --limit subset depends on the file order, so it cannot be reused
+    file_cache = {} if len(versions) > 1 and args.limit is None else None
+    profiler = FileProfiler() if args.profile else None
+    callbacks = []
+    if not args.no_progress and sys.stderr.isatty():
+        callbacks.append(ProgressBar())
+    if args.event_log:
+        callbacks.append(JsonLinesEventLog(args.event_log))
+    version2data = {}
+    for version, data_dir in version2dir.items():
+        if args.shard is not None:
+            print('[Info] Converting shard {} of v{} into {}'.format(
+                args.shard, version, data_dir))
+            convert_shard(args, data_dir, errors=errors, nlp=nlp,
+                          callbacks=callbacks)
+            continue
+        print('[Info] Converting v{} into {}'.format(version, data_dir))
+        version2data[version] = convert(args, data_dir, file_cache=file_cache,
+                                        profiler=profiler, errors=errors,
+                                        nlp=nlp, callbacks=callbacks)
+
+    if errors.errors:
+        errors.save(path.join(root_dir, 'errors.json' if args.shard is None else
+                              'errors.shard-{}-of-{}.json'.format(
+                                  *parse_shard(args.shard))))
+
+    if profiler is not None:
+        profiler.report(root_dir)
 
-    for typ in DataSetType:
-        data_reader = WebNLGDataReader(typ)
-        data_reader.save()
+    if args.shard is not None:
+        return
+    for version_a, version_b in zip(versions, versions[1:]):
+        diff_versions({version_a: version2data[version_a],
+                       version_b: version2data[version_b]}, root_dir)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--version', default="1.5", choices=["1.4", "1.5"])
+    parser.add_argument('--version', default="1.5", type=parse_versions,
+                        help='one of {}, or several separated by commas, '
+                             'e.g. 1.4,1.5'.format(' | '.join(VERSIONS)))
+    parser.add_argument('--strict', action='store_true',
+                        help='exit with an error at the first file or entry '
+                             'which fails to convert, instead of skipping it '
+                             'and listing it in errors.json')
+    parser.add_argument('--no-tokenize-cache', action='store_true',
+                        help='do not use the persistent spaCy output cache, '
+                             'data/webnlg/tokenize_cache.sqlite')
+    parser.add_argument('--xml-backend', default=None,
+                        choices=available_backends(),
+                        help='xml parser, default: the fastest installed')
+    parser.add_argument('--splits', default=[typ for typ in DataSetType],
+                        type=parse_splits,
+                        help='comma separated subset of test,train,dev')
+    parser.add_argument('--limit', default=None, type=int,
+                        help='stop converting a split after N records')
+    parser.add_argument('--sample', default=1., type=float,
+                        help='only convert this fraction of the entries')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='seed of --sample')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='convert on this many processes, in chunks of '
+                             '--chunk-size entries dispatched largest file '
+                             'first; the output is the same as with 1. '
+                             'Ignored with --limit and --profile')
+    parser.add_argument('--chunk-size', default=50, type=int,
+                        help='entries per chunk with --workers')
+    parser.add_argument('--prepare', action='store_true',
+                        help='only download, clean and index raw/, once '
+                             'before the nodes of a --shard run start')
+    parser.add_argument('--shard', default=None,
+                        help='i/N: convert only the entry chunks of shard i '
+                             'of N (from 0) of the prepared raw/, into '
+                             'partial/; run --merge once all shards are done')
+    parser.add_argument('--merge', action='store_true',
+                        help='combine the partial/ outputs of all shards into '
+                             'the same files as a single run with these '
+                             'options would write')
+    parser.add_argument('--num-shards', default=1, type=int,
+                        help='write each split as N shard files plus a manifest')
+    parser.add_argument('--shard-balance', default='records',
+                        choices=['records', 'bytes'])
+    parser.add_argument('--compression', default=None,
+                        choices=available_compressions(),
+                        help='write splits as compressed json')
+    parser.add_argument('--index', action='store_true',
+                        help='also save an entity/relation inverted index')
+    parser.add_argument('--only-eid', action='append', default=[],
+                        metavar='FILE:EID[,EID...]',
+                        help='only convert these entries of raw/FILE, e.g. '
+                             'train/1triples/Airport.xml:Id1,Id2, and show '
+                             'why their sentences are dropped')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='do not draw the progress bar on stderr')
+    parser.add_argument('--event-log', default=None,
+                        help='append conversion events to this json-lines '
+                             'file')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the conversion of each raw file and '
+                             'save a report of the slowest ones')
+    parser.add_argument('--mentions', action='store_true',
+                        help='add the token and character spans of each '
+                             'entity mention in target_txt to each record')
+    parser.add_argument('--stats', action='store_true',
+                        help='also save and show the dataset statistics')
+    parser.add_argument('--buckets', action='store_true',
+                        help='also save per-record token lengths grouped '
+                             'into length buckets')
+    parser.add_argument('--seq2seq', action='store_true',
+                        help='also save linearized triples and targets as '
+                             'token-id arrays')
+    parser.add_argument('--graph', action='store_true',
+                        help='also save the triples as CSR-style node/edge '
+                             'arrays (.npy)')
+    parser.add_argument('--dedup', default='off',
+                        choices=['off', 'report', 'remove'],
+                        help='find (triples, target_txt) duplicates within '
+                             'and across splits')
     main(parser.parse_args())
@@ -0,0 +1,162 @@
+import json
+import sys
+from array import array
+from os import path
+
+PAD, UNK, BOS, EOS = '<pad>', '<unk>', '<s>', '</s>'
+
+
+class Vocab:
+    def __init__(self, tokens=()):
+        self.itos = []
+        self.stoi = {}
+        for tok in tokens:
+            self.add(tok)
+
+    def add(self, tok):
+        if tok not in self.stoi:
+            self.stoi[tok] = len(self.itos)
+            self.itos.append(tok)
+        return self.stoi[tok]
+
+    def encode(self, toks, grow=True):
+        if grow:
+            return [self.add(tok) for tok in toks]
+        unk = self.stoi[UNK]
+        return [self.stoi.get(tok, unk) for tok in toks]
+
+    def decode(self, ids):
+        return [self.itos[i] for i in ids]
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.itos, f, indent=0)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            return cls(json.load(f))
+
+
+class TripleLinearizer:
+    '''
+    Turns `[(subj, rel, obj), ...]` into one token list, e.g. with the default
+    markers: `<H> Alan Bean <R> occupation <T> Test pilot`.
+    '''
+
+    def __init__(self, head='<H>', rel='<R>', tail='<T>', triple_sep=None,
+                 underscore_to_space=True):
+        self.head = head
+        self.rel = rel
+        self.tail = tail
+        self.triple_sep = triple_sep
+        self.underscore_to_space = underscore_to_space
+
+    @property
+    def special_tokens(self):
+        return [t for t in (self.head, self.rel, self.tail, self.triple_sep)
+                if t]
+
+    def split_words(self, phrase):
+        if self.underscore_to_space:
+            phrase = phrase.replace('_', ' ')
+        return phrase.split()
+
+    def __call__(self, triples):
+        toks = []
+        for triple_ix, (subj, rel, obj) in enumerate(triples):
+            if triple_ix and self.triple_sep:
+                toks.append(self.triple_sep)
+            for marker, phrase in ((self.head, subj), (self.rel, rel),
+                                   (self.tail, obj)):
+                if marker:
+                    toks.append(marker)
+                toks += self.split_words(phrase)
+        return toks
+
+
+class Seq2SeqExporter:
+    '''
+    Writes each split as flat uint32 token-id arrays plus uint64 offsets, one
+    pair of files per field, against a vocabulary shared by all splits:
+    `src` is the linearized triples, `tgt` the delexicalized `target` and
+    `txt` the lexicalized `target_txt` (both already tokenized by
+    `NLP.word_tokenize`, so they are split on whitespace).
+    '''
+    FIELDS = ('src', 'tgt', 'txt')
+
+    def __init__(self, linearizer=None, vocab=None):
+        self.linearizer = linearizer or TripleLinearizer()
+        self.vocab = vocab or Vocab([PAD, UNK, BOS, EOS] +
+                                    self.linearizer.special_tokens)
+
+    def record_tokens(self, record):
+        return {
+            'src': self.linearizer(record['triples']),
+            'tgt': record['target'].split(),
+            'txt': record['target_txt'].split(),
+        }
+
+    def save(self, data, save_dir, data_set_type):
+        ids = {field: array('I') for field in self.FIELDS}
+        offsets = {field: array('Q', [0]) for field in self.FIELDS}
+        for record in data:
+            for field, toks in self.record_tokens(record).items():
+                ids[field].extend(self.vocab.encode(toks))
+                offsets[field].append(len(ids[field]))
+
+        for field in self.FIELDS:
+            prefix = path.join(save_dir, '{}.{}'.format(data_set_type, field))
+            with open(prefix + '.ids', 'wb') as f:
+                ids[field].tofile(f)
+            with open(prefix + '.offsets', 'wb') as f:
+                offsets[field].tofile(f)
+
+    def save_vocab(self, save_dir):
+        vocab_f = path.join(save_dir, 'seq2seq.vocab.json')
+        self.vocab.save(vocab_f)
+        with open(path.join(save_dir, 'seq2seq.meta.json'), 'w') as f:
+            json.dump({'byteorder': sys.byteorder,
+                       'vocab_size': len(self.vocab.itos),
+                       'linearizer': vars(self.linearizer)}, f, indent=4)
+        print('[Info] Saved seq2seq vocab of {} tokens into {}'.format(
+            len(self.vocab.itos), vocab_f))
+
+
+class Seq2SeqSplit:
+    '''
+    Read side of `Seq2SeqExporter`: `split[i]` gives the token ids of record
+    `i` for each field, as slices of the flat arrays.
+    '''
+
+    def __init__(self, save_dir, data_set_type):
+        with open(path.join(save_dir, 'seq2seq.meta.json')) as f:
+            meta = json.load(f)
+        self.vocab = Vocab.load(path.join(save_dir, 'seq2seq.vocab.json'))
+        self.ids = {}
+        self.offsets = {}
+        for field in Seq2SeqExporter.FIELDS:
+            prefix = path.join(save_dir, '{}.{}'.format(data_set_type, field))
+            self.ids[field] = self._read_array('I', prefix + '.ids', meta)
+            self.offsets[field] = self._read_array('Q', prefix + '.offsets',
+                                                   meta)
+
+    @staticmethod
+    def _read_array(typecode, file_name, meta):
+        arr = array(typecode)
+        with open(file_name, 'rb') as f:
+            arr.frombytes(f.read())
+        if meta['byteorder'] != sys.byteorder:
+            arr.byteswap()
+        return arr
+
+    def __len__(self):
+        return len(self.offsets['src']) - 1
+
+    def get(self, record_ix, field):
+        offsets = self.offsets[field]
+        return self.ids[field][offsets[record_ix]:offsets[record_ix + 1]]
+
+    def __getitem__(self, record_ix):
+        return {field: self.get(record_ix, field)
+                for field in Seq2SeqExporter.FIELDS}
@@ -0,0 +1,143 @@
+import argparse
+import importlib
+import json
+import os
+import socketserver
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+from urllib.parse import urlparse, parse_qs
+
+sys.path.append(os.path.abspath('.'))
+import utils
+import reader
+from utils import DataSetType, NLP, ErrorLog
+from raw_index import RawIndex
+
+# names which reader.py imports from utils and which are edited while
+# iterating on fixes; `/reload` rebinds them without restarting the server
+FIX_TABLES = ['Cleaner', 'misspelling', 'rephrase', 'rephrase_if_must',
+              'fix_tokenize', 'fix_template_word']
+# cached helpers, rebound too so that no result of the old tables is reused
+CACHED = ['parse_triple', 'unquote_triple']
+
+
+class ConversionService:
+    '''
+    Keeps the spaCy pipeline loaded between requests, so converting a file,
+    an entry or a whole split only pays for the conversion itself.
+    '''
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir or path.dirname(path.realpath(__file__))
+        self.nlp = NLP()
+        self.raw_index = RawIndex(path.join(self.data_dir, 'raw'))
+
+    def resolve(self, file_name):
+        if path.isabs(file_name):
+            return file_name
+        # e.g. "train/1triples/Airport.xml", relative to raw/
+        return path.join(self.data_dir, 'raw', file_name)
+
+    def convert_file(self, file_name, eids=None):
+        errors = ErrorLog()
+        rdf = reader.RDFFileReader(self.resolve(file_name), nlp=self.nlp,
+                                   eids=eids, raw_index=self.raw_index,
+                                   errors=errors)
+        return {'file': file_name, 'records': rdf.data,
+                'cnt_dirty_data': rdf.cnt_dirty_data,
+                'cnt_corefs': rdf.cnt_corefs, 'errors': errors.errors}
+
+    def convert_entry(self, file_name, eids):
+        return self.convert_file(file_name, eids=set(eids))
+
+    def convert_split(self, split):
+        typ = DataSetType('dev' if split == 'valid' else split)
+        errors = ErrorLog()
+        data_reader = reader.WebNLGDataReader(typ, data_dir=self.data_dir,
+                                              nlp=self.nlp, errors=errors)
+        data_reader.save()
+        return {'split': split, 'num_records': len(data_reader.data),
+                'errors': errors.errors}
+
+    def reload(self):
+        importlib.reload(utils)
+        for name in FIX_TABLES + CACHED:
+            setattr(reader, name, getattr(utils, name))
+        return {'reloaded': FIX_TABLES + CACHED}
+
+    def handle(self, route, params):
+        if route == '/file':
+            return self.convert_file(params['path'][0])
+        if route == '/entry':
+            return self.convert_entry(params['path'][0],
+                                      params['eid'][0].split(','))
+        if route == '/split':
+            return self.convert_split(params['name'][0])
+        if route == '/reload':
+            return self.reload()
+        raise KeyError(route)
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        start = time.perf_counter()
+        try:
+            result = self.service.handle(url.path, parse_qs(url.query))
+            status = 200
+        except KeyError as e:
+            result, status = {'error': 'missing {}'.format(e)}, 400
+        except Exception as e:
+            result, status = {'error': repr(e)}, 500
+        result['seconds'] = round(time.perf_counter() - start, 4)
+
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        # unix sockets have no client address
+        return 'unix'
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer, HTTPServer):
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def main(args):
+    ConversionHandler.service = ConversionService(args.data_dir)
+    if args.socket:
+        if path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, ConversionHandler)
+        print('[Info] Serving conversions on unix socket {}'.format(args.socket))
+    else:
+        server = HTTPServer(('127.0.0.1', args.port), ConversionHandler)
+        print('[Info] Serving conversions on http://127.0.0.1:{}'.format(
+            args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=None)
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--socket', default=None,
+                        help='serve on this unix socket instead of a port')
+    main(parser.parse_args())
@@ -0,0 +1,133 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+import sys
+from os import path
+
+sys.path.append(os.path.abspath('.'))
+from utils import fwrite, load_json
+from stats import DatasetStats
+
+PARTIAL_DIR = 'partial'
+PARTIAL_NAME = re.compile(r'^(?P<split>\w+)-(?P<shard>\d{5})-of-(?P<num>\d{5})'
+                          r'\.json$')
+
+
+def parse_shard(spec):
+    '''
+    Parses `--shard i/N` into (i, N), with shards numbered from 0.
+    '''
+    shard, num_shards = (int(n) for n in spec.split('/'))
+    if not 0 <= shard < num_shards:
+        raise ValueError('--shard {} is not in 0/{} .. {}/{}'.format(
+            spec, num_shards, num_shards - 1, num_shards))
+    return shard, num_shards
+
+
+def plan_hash(plan, options):
+    '''
+    Fingerprint of the chunk plan [(file, sha256, eids)] and of the options
+    which change the records, so that partial outputs of shards which saw
+    different raw data or options are never merged.
+    '''
+    key = json.dumps([options, plan], sort_keys=True).encode('utf-8')
+    return hashlib.sha256(key).hexdigest()
+
+
+def assign_chunks(chunk_bytes, num_shards):
+    '''
+    Returns the shard of each chunk: the largest chunk goes to the least
+    loaded shard first, ties broken by index, so every node computes the same
+    assignment from the same plan.
+    '''
+    shard_of = [None] * len(chunk_bytes)
+    loads = [(0, shard) for shard in range(num_shards)]
+    for chunk_ix in sorted(range(len(chunk_bytes)),
+                           key=lambda ix: (-chunk_bytes[ix], ix)):
+        load, shard = heapq.heappop(loads)
+        shard_of[chunk_ix] = shard
+        heapq.heappush(loads, (load + chunk_bytes[chunk_ix], shard))
+    return shard_of
+
+
+def partial_file(data_dir, split, shard, num_shards):
+    return path.join(data_dir, PARTIAL_DIR, '{}-{:05d}-of-{:05d}.json'.format(
+        split, shard, num_shards))
+
+
+def save_partial(data_dir, split, shard, num_shards, plan_key, num_chunks,
+                 chunks, errors, stats: DatasetStats = None):
+    '''
+    Writes the records of one shard's chunks, `chunks` being
+    [(chunk_ix, records)], plus their stats next to them.
+    '''
+    os.makedirs(path.join(data_dir, PARTIAL_DIR), exist_ok=True)
+    partial_f = partial_file(data_dir, split, shard, num_shards)
+    partial = {'split': split, 'shard': shard, 'num_shards': num_shards,
+               'plan': plan_key, 'num_chunks': num_chunks,
+               'chunks': [{'chunk': chunk_ix, 'records': records}
+                          for chunk_ix, records in chunks],
+               'errors': errors}
+    fwrite(json.dumps(partial), partial_f)
+    if stats is not None:
+        stats.save(partial_f[:-len('.json')] + '.stats.json')
+    print('[Info] Saved {} chunks of shard {}/{} into {}'.format(
+        len(chunks), shard, num_shards, partial_f))
+
+
+def load_partials(data_dir, split):
+    '''
+    Reads the partial outputs of all shards of `split`, checks that they come
+    from the same plan and cover each chunk exactly once, and returns the
+    records per chunk in chunk order, the errors in the same order, and the
+    merged stats (None unless every shard saved its stats).
+    '''
+    partial_dir = path.join(data_dir, PARTIAL_DIR)
+    partial_fs = sorted(
+        f for f in (os.listdir(partial_dir) if path.isdir(partial_dir) else [])
+        if PARTIAL_NAME.match(f) and PARTIAL_NAME.match(f).group('split') ==
+        split)
+    if not partial_fs:
+        raise ValueError('No partial outputs of {} in {}'.format(
+            split, partial_dir))
+
+    partials = [load_json(path.join(partial_dir, f)) for f in partial_fs]
+    num_shards = {p['num_shards'] for p in partials}
+    plans = {p['plan'] for p in partials}
+    if len(num_shards) > 1 or len(plans) > 1:
+        raise ValueError('Partial outputs of {} in {} come from different '
+                         'runs (--shard i/N, raw data or options differ)'
+                         .format(split, partial_dir))
+    num_shards = num_shards.pop()
+    missing = sorted(set(range(num_shards)) - {p['shard'] for p in partials})
+    if missing:
+        raise ValueError('Shards {} of {} are missing for {} in {}'.format(
+            missing, num_shards, split, partial_dir))
+
+    chunk2records, chunk2errors = {}, {}
+    for partial in partials:
+        for chunk in partial['chunks']:
+            if chunk['chunk'] in chunk2records:
+                raise ValueError('Chunk {} of {} is in several shards'.format(
+                    chunk['chunk'], split))
+            chunk2records[chunk['chunk']] = chunk['records']
+        for error in partial['errors']:
+            chunk2errors.setdefault(error.pop('chunk'), []).append(error)
+    num_chunks = partials[0]['num_chunks']
+    if sorted(chunk2records) != list(range(num_chunks)):
+        raise ValueError('Partial outputs of {} have {} of {} chunks'.format(
+            split, len(chunk2records), num_chunks))
+
+    stats = None
+    stats_fs = [path.join(partial_dir, f[:-len('.json')] + '.stats.json')
+                for f in partial_fs]
+    if all(path.isfile(f) for f in stats_fs):
+        stats = DatasetStats()
+        for stats_f in stats_fs:
+            stats.merge(DatasetStats.from_dict(load_json(stats_f)))
+
+    errors = [error for chunk_ix in sorted(chunk2errors)
+              for error in chunk2errors[chunk_ix]]
+    return [chunk2records[ix] for ix in range(num_chunks)], errors, stats
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+from os import path
+
+sys.path.append(os.path.abspath('.'))
+from utils import iter_json_array, COMPRESSION_EXTS
+
+SPLITS = ['train', 'valid', 'test']
+
+
+class DatasetStats:
+    '''
+    Mergeable counters behind the "Overview of dataset" numbers in the README:
+    size, vocabularies of entities, ner tags, relations, txt and tgt words,
+    and the avg/max length of `target`. Stats of shards or splits are combined
+    with `merge`.
+    '''
+    VOCABS = ('ent', 'ner', 'rel', 'txt', 'tgt')
+
+    def __init__(self):
+        self.size = 0
+        self.vocabs = {name: set() for name in self.VOCABS}
+        self.tgt_len_sum = 0
+        self.tgt_len_max = 0
+
+    def update(self, record):
+        self.size += 1
+        self.vocabs['ent'].update(record['ner2ent'].values())
+        self.vocabs['ner'].update(tag.lower() for tag in record['ner2ent'])
+        self.vocabs['rel'].update(rel for _, rel, _ in record['triples'])
+        self.vocabs['txt'].update(record['target_txt'].lower().split())
+        tgt = record['target'].lower().split()
+        self.vocabs['tgt'].update(tgt)
+        self.tgt_len_sum += len(tgt)
+        self.tgt_len_max = max(self.tgt_len_max, len(tgt))
+        return self
+
+    def update_all(self, records):
+        for record in records:
+            self.update(record)
+        return self
+
+    def merge(self, other):
+        self.size += other.size
+        for name in self.VOCABS:
+            self.vocabs[name] |= other.vocabs[name]
+        self.tgt_len_sum += other.tgt_len_sum
+        self.tgt_len_max = max(self.tgt_len_max, other.tgt_len_max)
+        return self
+
+    def summary(self):
+        summary = {'size': self.size}
+        summary.update({'vocab_' + name: len(vocab)
+                        for name, vocab in self.vocabs.items()})
+        summary['tgt_len_avg'] = round(self.tgt_len_sum / self.size, 1) \
+            if self.size else 0
+        summary['tgt_len_max'] = self.tgt_len_max
+        return summary
+
+    def to_dict(self):
+        return {'size': self.size,
+                'vocabs': {k: sorted(v) for k, v in self.vocabs.items()},
+                'tgt_len_sum': self.tgt_len_sum,
+                'tgt_len_max': self.tgt_len_max,
+                'summary': self.summary()}
+
+    @classmethod
+    def from_dict(cls, dic):
+        stats = cls()
+        stats.size = dic['size']
+        stats.vocabs = {k: set(v) for k, v in dic['vocabs'].items()}
+        stats.tgt_len_sum = dic['tgt_len_sum']
+        stats.tgt_len_max = dic['tgt_len_max']
+        return stats
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            return cls.from_dict(json.load(f))
+
+
+def split_files(data_dir, split):
+    manifest_f = path.join(data_dir, split + '.manifest.json')
+    if path.isfile(manifest_f):
+        with open(manifest_f) as f:
+            manifest = json.load(f)
+        return [path.join(data_dir, shard['file'])
+                for shard in manifest['shards']]
+    for ext in [''] + list(COMPRESSION_EXTS.values()):
+        file_name = path.join(data_dir, split + '.json' + ext)
+        if path.isfile(file_name):
+            return [file_name]
+    return []
+
+
+def file_stats(file_name):
+    # one streaming pass, without loading the whole split
+    return DatasetStats().update_all(iter_json_array(file_name))
+
+
+def compute_stats(data_dir, splits=SPLITS, num_workers=None):
+    jobs = [(split, f) for split in splits for f in split_files(data_dir, split)]
+    with Pool(num_workers) as pool:
+        results = pool.map(file_stats, [f for _, f in jobs])
+
+    split2stats = {split: DatasetStats() for split in splits}
+    for (split, _), stats in zip(jobs, results):
+        split2stats[split].merge(stats)
+    return split2stats
+
+
+def show_stats(split2stats):
+    total = DatasetStats()
+    for split, stats in split2stats.items():
+        total.merge(stats)
+        print('[Info] {}: {}'.format(split, json.dumps(stats.summary())))
+    print('[Info] all: {}'.format(json.dumps(total.summary())))
+    return total
+
+
+def main(args):
+    split2stats = compute_stats(args.data_dir, args.splits.split(','),
+                                num_workers=args.workers)
+    show_stats(split2stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=path.dirname(path.realpath(__file__)))
+    parser.add_argument('--splits', default=','.join(SPLITS))
+    parser.add_argument('--workers', default=None, type=int)
+    main(parser.parse_args())
@@ -2,10 +2,21 @@
 from __future__ import division, unicode_literals, print_function
 
 import itertools
+import functools
 import re
 import json
+import hashlib
+import gzip
+import queue
+import threading
+import time
+import io
+import cProfile
+import pstats
+import sqlite3
 
 from enum import Enum
+from collections import defaultdict, OrderedDict
 from typing import List, Tuple, Dict, Callable
 
 import sys
@@ -18,6 +29,16 @@ except ImportError:
     os.system('python -m spacy download en')
     import spacy
 
+# optional codecs for compressed output; gzip is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 ALPHA = chr(2)  # Start of text
 OMEGA = chr(3)  # End of text
 SPLITABLES = {ALPHA, OMEGA, " ", ".", ",", ":", "-", "'", "(", ")", "?", "!",
@@ -693,13 +714,111 @@ class Cleaner():
         }
 
 
+class TokenizationCache:
+    '''
+    Persistent cache of `NLP` outputs in SQLite, keyed by a hash of the
+    tokenizer fingerprint, the operation and the input text, with an
+    in-memory LRU in front. Each row remembers the raw file it was first
+    computed for, so `prefetch` can load a whole file's rows in one query.
+    '''
+
+    def __init__(self, path, max_size=100000):
+        self.db_path = path
+        # worker processes write to the same file, so wait out their locks
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tokenized ('
+                          'key BLOB PRIMARY KEY, source TEXT, value TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tokenized_source '
+                          'ON tokenized (source)')
+        self.lru = OrderedDict()
+        self.max_size = max_size
+        self.fingerprint = ''
+        self.source = None
+        self.prefetched = set()
+        self.pending = []
+        self.cnt_hits = 0
+        self.cnt_misses = 0
+
+    def key(self, op, text):
+        return hashlib.blake2b('\0'.join([self.fingerprint, op, text])
+                               .encode('utf-8'), digest_size=16).digest()
+
+    def _remember(self, key, value):
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+
+    def get(self, op, text):
+        key = self.key(op, text)
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            self.cnt_hits += 1
+            return self.lru[key]
+        row = self.conn.execute('SELECT value FROM tokenized WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            self.cnt_misses += 1
+            return None
+        self.cnt_hits += 1
+        value = json.loads(row[0])
+        self._remember(key, value)
+        return value
+
+    def put(self, op, text, value):
+        key = self.key(op, text)
+        self._remember(key, value)
+        self.pending.append((key, self.source, json.dumps(value)))
+
+    def prefetch(self, source):
+        self.flush()
+        self.source = source
+        # e.g. once per chunk of a file with --workers; rows which fell out
+        # of the LRU since are still found by `get`
+        if source in self.prefetched: return
+        self.prefetched.add(source)
+        rows = self.conn.execute('SELECT key, value FROM tokenized '
+                                 'WHERE source = ?', (source,))
+        for key, value in rows:
+            self._remember(key, json.loads(value))
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany('INSERT OR IGNORE INTO tokenized '
+                                  'VALUES (?, ?, ?)', self.pending)
+            self.conn.commit()
+            self.pending = []
+
+
 class NLP:
-    def __init__(self):
+    def __init__(self, cache: TokenizationCache = None):
 
         self.nlp = spacy.load('en_core_web_sm', disable=['ner', 'parser', 'tagger'])
         self.nlp.add_pipe('sentencizer')
 
+        self.cache = cache
+        if cache is not None:
+            cache.fingerprint = json.dumps(
+                [spacy.__version__, self.nlp.meta.get('name'),
+                 self.nlp.meta.get('version'), self.nlp.pipe_names])
+
+    def _cached(self, op, text, func):
+        if self.cache is None:
+            return func(text)
+        result = self.cache.get(op, text)
+        if result is None:
+            result = func(text)
+            self.cache.put(op, text, result)
+        return result
+
+    def prefetch(self, source):
+        if self.cache is not None:
+            self.cache.prefetch(source)
+
     def sent_tokenize(self, text):
+        return self._cached('sent', text, self._sent_tokenize)
+
+    def _sent_tokenize(self, text):
         doc = self.nlp(text)
         sentences = [str(sent).strip() for sent in doc.sents]
         return sentences
@@ -708,10 +827,242 @@ class NLP:
         if text is None: return text
         text = ' '.join(text.split())
         if lower: text = text.lower()
+        return self._cached('word', text, self._word_tokenize)
+
+    def _word_tokenize(self, text):
         toks = [tok.text for tok in self.nlp.tokenizer(text)]
         return ' '.join(toks)
 
 
+class Deduplicator:
+    '''
+    Finds duplicated (triples, target_txt) records within and across splits.
+    Only a 64-bit hash per distinct record is kept in memory. The first split
+    which sees a record owns it, so with the `DataSetType` order (test, train,
+    dev) records leaking from test into train are the ones flagged.
+    '''
+
+    def __init__(self, remove=False):
+        self.remove = remove
+        self.hash2split = {}
+        self.cnt_within = defaultdict(int)
+        self.cnt_cross = defaultdict(int)
+
+    @staticmethod
+    def normalize_text(text):
+        return ' '.join(text.lower().split())
+
+    def record_hash(self, record):
+        triples = sorted('|'.join(self.normalize_text(part) for part in triple)
+                         for triple in record['triples'])
+        key = '\t'.join(triples) + '\n' + \
+              self.normalize_text(record['target_txt'])
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def filter(self, records, split):
+        for record in records:
+            key = self.record_hash(record)
+            seen_split = self.hash2split.get(key)
+            if seen_split is None:
+                self.hash2split[key] = split
+            elif seen_split == split:
+                self.cnt_within[split] += 1
+                if self.remove: continue
+            else:
+                self.cnt_cross[(seen_split, split)] += 1
+                if self.remove: continue
+            yield record
+
+    def report(self):
+        report = {
+            'num_hashes': len(self.hash2split),
+            'removed': self.remove,
+            'within_split': dict(self.cnt_within),
+            'cross_split': {'{}->{}'.format(*k): v
+                            for k, v in self.cnt_cross.items()},
+        }
+        print('[Info] Dedup report: {}'.format(json.dumps(report)))
+        return report
+
+
+class FileProfiler:
+    '''
+    Profiles each raw file's conversion separately, so the slowest files and
+    the functions dominating them can be ranked, and merges all the profiles
+    into one `pstats` dump for the whole run.
+    '''
+
+    def __init__(self):
+        self.file2time = {}
+        self.file2stats = {}
+
+    def run(self, file_name, func, *args, **kwargs):
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            self.file2time[file_name] = time.perf_counter() - start
+            self.file2stats[file_name] = pstats.Stats(profiler)
+
+    def report(self, save_dir, top_files=20, top_funcs=10):
+        ranked = sorted(self.file2time.items(), key=lambda x: -x[1])
+        total = sum(self.file2time.values())
+
+        report = io.StringIO()
+        report.write('Profiled {} files, {:.2f}s in total\n'.format(
+            len(ranked), total))
+        for rank, (file_name, seconds) in enumerate(ranked[:top_files], 1):
+            report.write('\n#{} {:.3f}s ({:.1f}%) {}\n'.format(
+                rank, seconds, 100 * seconds / total if total else 0,
+                file_name))
+            stats = self.file2stats[file_name]
+            stats.stream = report
+            stats.sort_stats('tottime').print_stats(top_funcs)
+
+        report_f = os.path.join(save_dir, 'profile_report.txt')
+        fwrite(report.getvalue(), report_f)
+
+        dump_f = os.path.join(save_dir, 'profile.pstats')
+        merged = pstats.Stats()
+        merged.add(*self.file2stats.values())
+        merged.dump_stats(dump_f)
+        print('[Info] Saved profile report into {}, merged stats into {}'
+              .format(report_f, dump_f))
+
+
+class EntrySampler:
+    '''
+    Picks the entries to convert for quick subsets: each entry is kept with
+    probability `fraction`, decided by a hash of (seed, file, eid) so the same
+    subset comes out whatever the file order, and conversion stops once
+    `limit` records were produced.
+    '''
+
+    def __init__(self, fraction=1., seed=0, limit=None):
+        self.fraction = fraction
+        self.seed = seed
+        self.limit = limit
+        self.cnt_records = 0
+
+    @property
+    def done(self):
+        return self.limit is not None and self.cnt_records >= self.limit
+
+    def keep(self, file_key, eid):
+        if self.fraction >= 1:
+            return True
+        key = '{}\t{}\t{}'.format(self.seed, file_key, eid).encode('utf-8')
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return int.from_bytes(digest, 'little') < self.fraction * 2 ** 64
+
+    def add(self, num_records):
+        self.cnt_records += num_records
+
+
+class ProgressBar:
+    '''
+    Conversion event callback drawing a progress line on stderr: files and
+    entries done, entries/sec, and an ETA from the raw bytes left to read.
+    '''
+
+    def __init__(self, stream=sys.stderr, min_interval=0.2):
+        self.stream = stream
+        self.min_interval = min_interval
+        self.last_draw = 0
+
+    def __call__(self, event, **info):
+        if event == 'split_started':
+            self.split = info['split']
+            self.total_files, self.total_bytes = info['files'], info['bytes']
+            self.done_files = self.done_bytes = self.entries = 0
+            self.start = time.perf_counter()
+        elif event == 'entry':
+            self.entries += 1
+        elif event == 'file_finished':
+            self.done_files += 1
+            self.done_bytes += info['bytes']
+        elif event == 'split_finished':
+            self.draw(force=True)
+            self.stream.write('\n')
+            return
+        self.draw()
+
+    def draw(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_draw < self.min_interval: return
+        self.last_draw = now
+        seconds = now - self.start
+        eta = '{:.0f}s'.format(
+            seconds * (self.total_bytes - self.done_bytes) / self.done_bytes) \
+            if self.done_bytes else '?'
+        self.stream.write('\r[{}] {}/{} files, {} entries, {:.0f} entries/s, '
+                          'ETA {} '.format(
+            self.split, self.done_files, self.total_files, self.entries,
+            self.entries / seconds if seconds else 0, eta))
+        self.stream.flush()
+
+
+class JsonLinesEventLog:
+    '''
+    Conversion event callback appending one json object per event to a file,
+    for job schedulers to scrape. Per-entry events are summed up into a
+    `progress` event at most every `interval` seconds.
+    '''
+
+    def __init__(self, path, interval=5.):
+        self.f = open(path, 'a')
+        self.interval = interval
+        self.entries = 0
+        self.last_progress = time.time()
+
+    def write(self, event, **info):
+        info.update(time=round(time.time(), 3), event=event)
+        self.f.write(json.dumps(info) + '\n')
+        self.f.flush()
+
+    def __call__(self, event, **info):
+        if event != 'entry':
+            self.write(event, **info)
+            return
+        self.entries += 1
+        if time.time() - self.last_progress >= self.interval:
+            self.write('progress', entries=self.entries)
+            self.last_progress = time.time()
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ErrorLog:
+    '''
+    Collects the files/entries which fail to convert, so that unattended runs
+    skip them and go on. With `strict=True` the first failure is raised as a
+    `ConversionError` instead.
+    '''
+
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.errors = []
+
+    def record(self, file_name, eid, exception):
+        error = {'file': file_name, 'eid': eid,
+                 'exception': type(exception).__name__,
+                 'message': str(exception)}
+        if self.strict:
+            raise ConversionError(json.dumps(error)) from exception
+        self.errors.append(error)
+        print('[Error] Skipped {}'.format(json.dumps(error)))
+
+    def save(self, path):
+        fwrite(json.dumps(self.errors, indent=4), path)
+        print('[Info] Saved {} errors into {}'.format(len(self.errors), path))
+
+
 def show_var(expression,
              joiner='\n', print=print):
     '''
@@ -755,15 +1106,129 @@ def fwrite(new_doc, path, mode='w', no_overwrite=False):
         print("[Info] Path does not exist in fwrite():", str(path))
         return
     if no_overwrite and os.path.isfile(path):
-        print("[Error] pls choose whether to continue, as file already exists:",
-              path)
-        import pdb
-        pdb.set_trace()
-        return
+        raise FileExistsError(path)
     with open(path, mode) as f:
         f.write(new_doc)
 
 
+COMPRESSION_EXTS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+
+
+def available_compressions():
+    return ['gzip'] + (['zstd'] if zstandard else []) + (['lz4'] if lz4 else [])
+
+
+def open_compressed(path, mode='rb', compression=None):
+    if compression is None:
+        compression = {ext: c for c, ext in COMPRESSION_EXTS.items()}.get(
+            os.path.splitext(path)[-1])
+    if compression is None:
+        return open(path, mode)
+    if compression not in available_compressions():
+        raise ValueError(compression + " is not available")
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == 'lz4':
+        return lz4.frame.open(path, mode)
+    if 'w' in mode:
+        return zstandard.ZstdCompressor(threads=-1).stream_writer(
+            open(path, mode), closefd=True)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, mode),
+                                                      closefd=True)
+
+
+def fwrite_compressed(chunks, path, compression='gzip', chunk_size=1 << 20):
+    '''
+    Writes an iterable of str `chunks` (e.g. from `JSONEncoder.iterencode`)
+    into a compressed file. Encoding and compression run in a background
+    thread so they overlap with producing the chunks; returns the number of
+    uncompressed bytes and their sha256.
+    '''
+    blocks = queue.Queue(maxsize=8)
+    digest = hashlib.sha256()
+    errors = []
+
+    def consume():
+        try:
+            with open_compressed(path, 'wb', compression) as f:
+                while True:
+                    block = blocks.get()
+                    if block is None: break
+                    f.write(block)
+        except Exception as e:
+            errors.append(e)
+            # keep draining so the producer never blocks on a full queue
+            while blocks.get() is not None: pass
+
+    worker = threading.Thread(target=consume, daemon=True)
+    worker.start()
+
+    num_bytes = 0
+    buffer, buffer_len = [], 0
+    try:
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                buffer.append(chunk)
+                buffer_len += len(chunk)
+                if buffer_len < chunk_size: continue
+            block = ''.join(buffer).encode('utf-8')
+            buffer, buffer_len = [], 0
+            digest.update(block)
+            num_bytes += len(block)
+            blocks.put(block)
+    finally:
+        # also when `chunks` raises, so that the writer closes the file
+        blocks.put(None)
+        worker.join()
+    if errors:
+        raise errors[0]
+    return num_bytes, digest.hexdigest()
+
+
+def load_json(path):
+    with open_compressed(path, 'rb') as f:
+        return json.load(f)
+
+
+def iter_json_array(path, block_size=1 << 20):
+    '''
+    Yields the items of a (possibly compressed) json array file one by one,
+    holding only about one item and one block of the file in memory.
+    '''
+    decoder = json.JSONDecoder()
+    skip = re.compile(r'[\s,]*')
+    with io.TextIOWrapper(open_compressed(path, 'rb'), encoding='utf-8') as f:
+        buffer = ''
+        while not buffer.strip():
+            block = f.read(block_size)
+            if not block: break
+            buffer += block
+        buffer = buffer.lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(path + ' is not a json array')
+        # decode by position, so the buffer is only copied once per block
+        pos = 1
+        eof = False
+        while True:
+            pos = skip.match(buffer, pos).end()
+            if buffer.startswith(']', pos):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # a number cut off at the end of the block, e.g. "2" of "2.5",
+                # also parses, so the item must be followed by a delimiter
+                if eof or end < len(buffer) and buffer[end] in ' \t\r\n,]':
+                    yield item
+                    pos = end
+                    continue
+            except json.JSONDecodeError:
+                if eof: raise
+            block = f.read(block_size)
+            eof = not block
+            buffer = buffer[pos:] + block
+            pos = 0
+
+
 def shell(cmd, working_directory='.', stdout=False, stderr=False):
     import subprocess
     from subprocess import PIPE, Popen
@@ -780,6 +1245,22 @@ def shell(cmd, working_directory='.', stdout=False, stderr=False):
     return subp_stdout, subp_stderr
 
 
+@functools.lru_cache(maxsize=None)
+def parse_triple(triple):
+    '''
+    Parses "subj | pred | obj" into a stripped tuple. Parts are interned and
+    results are memoized, so a triple string repeated across lexes and
+    entries is parsed once and shares one tuple object.
+    '''
+    return tuple(sys.intern(part.strip()) for part in triple.split("|"))
+
+
+@functools.lru_cache(maxsize=None)
+def unquote_triple(triple):
+    subj, predi, obj = triple
+    return sys.intern(subj.strip('\"')), predi, sys.intern(obj.strip('\"'))
+
+
 def flatten_list(nested_list):
     from itertools import chain
     return list(chain.from_iterable(nested_list))
@@ -995,6 +1476,8 @@ def rephrase_if_must(entity):
     phrasings = {entity}
 
     for s, rephs in rephrasing_must.items():
+        # rephrasing_must maps to a single string, not a list like rephrasing
+        if isinstance(rephs, str): rephs = [rephs]
         for p in filter(lambda p: s in p, set(phrasings)):
             for r in rephs:
                 phrasings.add(p.replace(s, r))